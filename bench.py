@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""Offline upload benchmarks against a mock GitHub server.
+
+Uploads batches of random files through ghuc to a mockgithub.MockGitHub
+instance, across a matrix of file sizes, batch sizes and job counts, and
+reports throughput (files/s and MB/s), per-upload latency (p50 and p99)
+and peak RSS. Every configuration runs in a fresh subprocess, so that peak
+RSS is measured per configuration; --mode cli benchmarks the ghuc command
+line (main) instead of ghuc.Uploader, in which case per-upload latency is
+not available.
+
+Example:
+
+    python bench.py --sizes 10K,1M,25M --batches 1,10,100 --jobs 1,8 \\
+        --latency 0.05 --bandwidth 100M
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import ghuc
+import mockgithub
+
+HERE = pathlib.Path(__file__).parent.resolve()
+GHUC = HERE / "ghuc.py"
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def format_size(n):
+    for unit in ("G", "M", "K"):
+        if n >= UNITS[unit] and n % UNITS[unit] == 0:
+            return "%d%s" % (n // UNITS[unit], unit)
+    return str(n)
+
+
+def percentile(values, p):
+    # Nearest-rank percentile.
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, int(round(p / 100 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_rss(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def make_files(directory, size, count):
+    paths = []
+    for i in range(count):
+        path = directory / ("%d.bin" % i)
+        with path.open("wb") as fp:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1 << 20))
+                fp.write(chunk)
+                remaining -= len(chunk)
+        paths.append(path)
+    return paths
+
+
+def seed_credentials(data_dir, config):
+    store = ghuc.CredentialStore(data_dir)
+    store.directory.mkdir(parents=True, exist_ok=True)
+    with store.lock():
+        store.save(
+            [{"name": "user_session", "value": config["session"]}], config["token"]
+        )
+
+
+def run_one(config):
+    # Runs a single configuration; called in a fresh subprocess.
+    with tempfile.TemporaryDirectory(prefix="ghuc-bench-") as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+        files_dir = tmpdir / "files"
+        files_dir.mkdir()
+        paths = make_files(files_dir, config["size"], config["batch"])
+        latencies = []
+        if config["mode"] == "api":
+            data_dir = tmpdir / "data"
+            seed_credentials(data_dir, config)
+            uploader = ghuc.Uploader(
+                jobs=config["jobs"],
+                use_cache=False,
+                data_dir=data_dir,
+                github_url=config["url"],
+            )
+            uploader.ensure_credentials()
+            upload = uploader.upload
+
+            def timed_upload(path, info=None):
+                start = time.monotonic()
+                try:
+                    return upload(path, info)
+                finally:
+                    latencies.append(time.monotonic() - start)
+
+            uploader.upload = timed_upload
+            start = time.monotonic()
+            errors = sum(1 for r in uploader.upload_many(paths) if r.error)
+            elapsed = time.monotonic() - start
+            rss = peak_rss(resource.RUSAGE_SELF) if resource else None
+        else:
+            seed_credentials(tmpdir / "ghuc", config)
+            env = dict(
+                os.environ, XDG_DATA_HOME=str(tmpdir), GHUC_GITHUB_URL=config["url"]
+            )
+            cmdline = [sys.executable, str(GHUC), "--no-cache", "--no-daemon", "-q"]
+            cmdline += ["-j", str(config["jobs"])] + [str(p) for p in paths]
+            start = time.monotonic()
+            p = subprocess.run(cmdline, env=env, stdout=subprocess.PIPE)
+            elapsed = time.monotonic() - start
+            errors = config["batch"] - len(p.stdout.splitlines())
+            rss = peak_rss(resource.RUSAGE_CHILDREN) if resource else None
+    return {
+        "size": config["size"],
+        "batch": config["batch"],
+        "jobs": config["jobs"],
+        "errors": errors,
+        "elapsed": elapsed,
+        "files_per_sec": config["batch"] / elapsed,
+        "mb_per_sec": config["batch"] * config["size"] / elapsed / 1e6,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_rss": rss,
+    }
+
+
+def format_row(result):
+    def ms(t):
+        return "-" if t is None else "%.1f" % (t * 1000)
+
+    rss = result["peak_rss"]
+    return "%8s %6d %5d %9.1f %9.2f %9s %9s %10s %6d" % (
+        format_size(result["size"]),
+        result["batch"],
+        result["jobs"],
+        result["files_per_sec"],
+        result["mb_per_sec"],
+        ms(result["p50"]),
+        ms(result["p99"]),
+        "-" if rss is None else "%.1f" % (rss / 1e6),
+        result["errors"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ghuc uploads against a local mock GitHub server."
+    )
+    parser.add_argument(
+        "--sizes", default="10K,1M,10M", help="comma-separated file sizes"
+    )
+    parser.add_argument(
+        "--batches", default="1,10,50", help="comma-separated batch sizes"
+    )
+    parser.add_argument("--jobs", default="1,4", help="comma-separated job counts")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds of latency added to every response (defaults to 0.02)",
+    )
+    parser.add_argument(
+        "--bandwidth", help="upload bandwidth cap per connection, e.g. 100M"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("api", "cli"),
+        default="api",
+        help="benchmark ghuc.Uploader (api, the default) or the ghuc command (cli)",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print results as JSON lines"
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_one(json.loads(args.child))))
+        return
+
+    bandwidth = ghuc.parse_size(args.bandwidth) if args.bandwidth else None
+    with mockgithub.MockGitHub(latency=args.latency, bandwidth=bandwidth) as mock:
+        if not args.json:
+            print(
+                "%8s %6s %5s %9s %9s %9s %9s %10s %6s"
+                % (
+                    "size",
+                    "batch",
+                    "jobs",
+                    "files/s",
+                    "MB/s",
+                    "p50(ms)",
+                    "p99(ms)",
+                    "RSS(MB)",
+                    "errors",
+                )
+            )
+        for size in map(ghuc.parse_size, args.sizes.split(",")):
+            for batch in map(int, args.batches.split(",")):
+                for jobs in map(int, args.jobs.split(",")):
+                    config = {
+                        "mode": args.mode,
+                        "url": mock.url,
+                        "session": mock.session,
+                        "token": mock.token,
+                        "size": size,
+                        "batch": batch,
+                        "jobs": jobs,
+                    }
+                    output = subprocess.check_output(
+                        [sys.executable, __file__, "--child", json.dumps(config)],
+                        cwd=str(HERE),
+                    )
+                    result = json.loads(output.decode("utf-8"))
+                    if args.json:
+                        print(json.dumps(result), flush=True)
+                    else:
+                        print(format_row(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
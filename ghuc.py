@@ -1,387 +1,3623 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
 import collections
+import concurrent.futures
+import contextlib
 import getpass
+import glob
+import gzip
+import hashlib
+import importlib.util
+import io
 import json
 import logging
-import logging.config
 import mimetypes
 import os
 import pathlib
+import queue
+import random
 import re
+import shutil
+import socket
+import struct
 import sys
 import tempfile
+import threading
+import time
 import urllib.parse
 
-import pyotp
 import xdgappdirs as appdirs
-from selenium.webdriver import Chrome, Firefox
-from selenium.common.exceptions import (
-    WebDriverException,
-    NoSuchElementException,
-    JavascriptException,
-)
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from urllib3 import PoolManager, ProxyManager, Timeout
+from urllib3._collections import HTTPHeaderDict
 from urllib3.exceptions import HTTPError
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary, encode_multipart_formdata
+
+# Heavy and/or optional dependencies (selenium, pyotp, python-magic, SOCKS
+# support in urllib3, httpx) are imported on first use, since the common path
+# (uploading with cached credentials) doesn't need them, and ghuc is often
+# invoked many times in quick succession. Importing this module must not
+# have side effects either; see configure_logging.
+
+
+GITHUB_URL = "https://github.com"
+# Logging in through this page lands us on an issue page, which has a
+# comment box and therefore an uploadPolicyAuthenticityToken.
+ISSUE_PATH = "/login?return_to=%2Fmojombo%2Fgrit%2Fissues%2F1"
+# Number of redirects followed when loading the issue page without a
+# browser.
+MAX_REDIRECTS = 5
+# Credentials refreshed less than this many seconds ago are never blamed
+# for upload failures. (Long-running processes like ghuc serve must be able
+# to refresh credentials more than once.)
+FRESH_CREDENTIALS_PERIOD = 60
+# Credentials are refreshed ahead of time once they are this far into
+# their expected lifetime: the token's, as learned from past expiries (see
+# CredentialStore.token_lifetime), or the session cookie's, from its
+# expiry date.
+REFRESH_AHEAD_FRACTION = 0.8
+# Number of observed token lifetimes remembered. Lifetimes shorter than
+# MIN_TOKEN_LIFETIME are not recorded: a token that stops working that
+# soon was revoked (e.g. by logging out), not expired.
+TOKEN_LIFETIME_SAMPLES = 10
+MIN_TOKEN_LIFETIME = 600
+SESSION_COOKIE = "user_session"
+# Seconds to wait for each page in the browser login flow.
+PAGE_LOAD_TIMEOUT = 30
+
+# CSS selectors for elements driving the browser login flow.
+LOGIN_SELECTOR = "input[name=login]"
+OTP_SELECTOR = "input[name=otp]"
+# For rarely used accounts, one could be presented with a confirmation page
+# for account recovery settings.
+POSTPONE_SELECTOR = "button[type=submit][value=postponed]"
+CSRF_SELECTOR = "input[data-csrf=true]"
+
+logger = logging.getLogger("ghuc")
+
+data_dir = appdirs.user_data_dir("ghuc", "org.zhimingwang", roaming=True, as_path=True)
+socket_file = data_dir / "ghuc.sock"
+cache_dir = appdirs.user_cache_dir("ghuc", "org.zhimingwang", as_path=True)
+
+# Upload cache eviction thresholds.
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_AGE = 90 * 86400
+
+# Optimized image cache eviction thresholds (see ImageOptimizer).
+OPTIMIZED_CACHE_MAX_ENTRIES = 1000
+OPTIMIZED_CACHE_MAX_AGE = 30 * 86400
+
+# UploadJournal syncs to disk at most this often (in seconds), or every
+# JOURNAL_SYNC_ENTRIES entries.
+JOURNAL_SYNC_INTERVAL = 1.0
+JOURNAL_SYNC_ENTRIES = 100
+
+# Extensions of file types accepted by GitHub, used to pick files found in
+# directories and glob matches.
+SUPPORTED_EXTENSIONS = frozenset(
+    [
+        ".docx",
+        ".gif",
+        ".gz",
+        ".jpeg",
+        ".jpg",
+        ".log",
+        ".pdf",
+        ".png",
+        ".pptx",
+        ".txt",
+        ".xlsx",
+        ".zip",
+    ]
+)
+
+# Default upload policy: size limits (in bytes) of MIME types known to be
+# accepted by GitHub. Overridable in policy.json in the data directory; see
+# UploadPolicy.
+DEFAULT_SIZE_LIMITS = collections.OrderedDict(
+    [
+        ("image/gif", 10 << 20),
+        ("image/jpeg", 10 << 20),
+        ("image/png", 10 << 20),
+        ("application/gzip", 25 << 20),
+        ("application/x-gzip", 25 << 20),
+        ("application/pdf", 25 << 20),
+        ("application/zip", 25 << 20),
+        ("text/plain", 25 << 20),
+        (
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            25 << 20,
+        ),
+        (
+            "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+            25 << 20,
+        ),
+        (
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            25 << 20,
+        ),
+    ]
+)
+# MIME types learned to be rejected are attempted again after this long, in
+# case GitHub has started accepting them.
+POLICY_REJECTION_MAX_AGE = 30 * 86400
+
+# Throttled uploads are retried up to this many times; without a
+# Retry-After, the delay before the nth retry is 2^n seconds, capped at
+# THROTTLE_MAX_DELAY.
+MAX_THROTTLED_RETRIES = 5
+THROTTLE_MAX_DELAY = 60
+# Phases failing with network errors or 5xx responses are retried (just
+# the failed phase; see Uploader._upload_to_github) up to this many times
+# per upload, with full jitter: the delay before the nth retry is random,
+# up to PHASE_RETRY_BASE_DELAY * 2^(n-1) seconds, capped at
+# PHASE_RETRY_MAX_DELAY.
+MAX_PHASE_RETRIES = 4
+PHASE_RETRY_BASE_DELAY = 0.5
+PHASE_RETRY_MAX_DELAY = 15
+# A transfer is only retried with the same upload policy if the policy
+# has at least this many seconds left before it expires.
+POLICY_EXPIRY_MARGIN = 60
+# AdaptiveLimiter cuts concurrency when request latency exceeds this
+# multiple of the baseline latency (plus LATENCY_SLACK seconds, so that
+# jitter on fast connections doesn't count).
+LATENCY_TOLERANCE = 3
+LATENCY_SLACK = 0.05
+
+# Uploads in flight per job in Uploader.upload_many and the daemon. Each
+# phase (policy, transfer, register) runs at most jobs at a time; with up
+# to PIPELINE_DEPTH * jobs uploads in flight, the phases of different
+# uploads overlap.
+PIPELINE_DEPTH = 3
+
+# Maximum number of connections per host opened by Uploader.prewarm.
+PREWARM_CONNECTIONS = 4
+
+# Files compressed for upload (--bundle, --gzip) are kept in memory up to
+# this size, and spooled to a temporary file beyond.
+SPOOL_THRESHOLD = 16 << 20
+
+# With gzip, .log and .txt files at least this large are compressed
+# before upload.
+GZIP_EXTENSIONS = frozenset([".log", ".txt"])
+GZIP_MIN_SIZE = 1 << 20
+
+# With verify, how long (in seconds) a freshly registered asset may keep
+# responding 404, and the initial delay between attempts (doubled after
+# each one).
+VERIFY_TIMEOUT = 30
+VERIFY_INITIAL_DELAY = 0.25
+
+# Upper bounds (in seconds) of the buckets of phase latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# python-magic module, loaded on first use by detect_mime_type; False if
+# unavailable.
+magic = None
+
+__version__ = "0.1"
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class UploadError(Exception):
+    pass
+
+
+class TransientError(UploadError):
+    """Raised when a phase of an upload fails in a way worth retrying.
+
+    That is, with a network error or a 5xx response (other than one
+    asking us to slow down; see Throttled).
+    """
+
+
+class Throttled(UploadError):
+    """Raised when GitHub (or S3) asks us to slow down.
+
+    retry_after is the delay in seconds requested by the server, or None;
+    phase is the phase of the upload that was throttled (see Metrics).
+    """
+
+    def __init__(self, msg, retry_after=None, phase=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+        self.phase = phase
+
+
+def configure_logging():
+    # Equivalent to a minimal logging.config.dictConfig, without the cost of
+    # importing logging.config.
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%H:%M:%S")
+    )
+    handler.setLevel(logging.INFO)
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+
+
+def launch_firefox_driver(headless=True, container=False):
+    from selenium.webdriver import Firefox
+    from selenium.webdriver.firefox.options import Options as FirefoxOptions
+
+    logger.debug("loading geckodriver...")
+    options = FirefoxOptions()
+    options.headless = headless
+    set_eager_page_load_strategy(options)
+    # Don't load images, stylesheets or web fonts.
+    options.set_preference("permissions.default.image", 2)
+    options.set_preference("permissions.default.stylesheet", 2)
+    options.set_preference("browser.display.use_document_fonts", 0)
+    return Firefox(options=options)
+
+
+def launch_chrome_driver(headless=True, container=False):
+    from selenium.webdriver import Chrome
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+
+    logger.debug("loading chromedriver...")
+    options = ChromeOptions()
+    options.headless = headless
+    if container:
+        options.add_argument("--no-sandbox")
+    set_eager_page_load_strategy(options)
+    # Don't load images, stylesheets or web fonts.
+    options.add_experimental_option(
+        "prefs",
+        {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.managed_default_content_settings.stylesheets": 2,
+            "profile.managed_default_content_settings.fonts": 2,
+        },
+    )
+    return Chrome(options=options)
+
+
+# Available WebDriver launchers, in default order of preference.
+WEBDRIVER_LAUNCHERS = collections.OrderedDict(
+    [("firefox", launch_firefox_driver), ("chrome", launch_chrome_driver)]
+)
+
+
+def set_eager_page_load_strategy(options):
+    # Return from navigation on DOMContentLoaded rather than load; elements
+    # we need are waited for explicitly.
+    if hasattr(type(options), "page_load_strategy"):
+        options.page_load_strategy = "eager"
+    else:
+        # Selenium 3.
+        options.set_capability("pageLoadStrategy", "eager")
+
+
+def wait_for_any_element(driver, selectors, timeout):
+    # Waits until an element matching one of selectors (tried in order) is
+    # present, and returns (selector, element), or (None, None) on timeout.
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    def find(driver):
+        for selector in selectors:
+            elements = driver.find_elements(By.CSS_SELECTOR, selector)
+            if elements:
+                return selector, elements[0]
+        return False
+
+    try:
+        return WebDriverWait(driver, timeout).until(find)
+    except TimeoutException:
+        return None, None
+
+
+def wait_for_navigation(driver, element, timeout):
+    # Waits until element (on the page we're navigating away from) is gone.
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support import expected_conditions
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    try:
+        WebDriverWait(driver, timeout).until(expected_conditions.staleness_of(element))
+    except TimeoutException:
+        pass
+
+
+def write_page_source_and_report_error(source, msg):
+    fd, temp_path = tempfile.mkstemp(suffix=".html", prefix="ghuc-")
+    with os.fdopen(fd, "w") as fp:
+        fp.write(source)
+    logger.error("%s (page source written to %s)", msg, temp_path)
+    raise ExtractionError
+
+
+def secure_file_permissions(path):
+    if path.stat().st_mode & 0o7777 != 0o0600:
+        try:
+            path.chmod(0o0600)
+        except OSError:
+            logger.warning("%s: failed to chmod to 0600", path)
+
+
+def write_file_atomically(path, content, mode=None):
+    # Readers never see a partially written file. The file is private
+    # (0600) by default, as befits credentials; with mode, it is created
+    # with that mode as restricted by the umask, like open() would.
+    path = pathlib.Path(path)
+    if mode is None:
+        fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=".tmp-")
+    else:
+        temp_path = str(path.parent / (".tmp-%s" % os.urandom(8).hex()))
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, str(path))
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def detect_mime_type(path):
+    global magic
+
+    if magic is None:
+        try:
+            import magic as magic_module
+
+            magic = magic_module
+        except ImportError:
+            magic = False
+    path = str(path)
+    if magic:
+        return magic.from_file(path, mime=True)
+    else:
+        return mimetypes.guess_type(path)[0]
+
+
+def guess_mime_type(name):
+    # For content without a file on disk, e.g. bundles.
+    content_type, encoding = mimetypes.guess_type(name)
+    if encoding == "gzip":
+        return "application/gzip"
+    return content_type
+
+
+def sha256_file(path):
+    # path may also be a seekable binary file object, which is read from
+    # the start.
+    h = hashlib.sha256()
+    if hasattr(path, "read"):
+        fp = path
+        fp.seek(0)
+    else:
+        fp = path.open("rb")
+    try:
+        for chunk in iter(lambda: fp.read(1 << 16), b""):
+            h.update(chunk)
+    finally:
+        if fp is not path:
+            fp.close()
+    return h.hexdigest()
+
+
+def gzip_file(path):
+    # Returns a temporary file (see SPOOL_THRESHOLD) with the content of
+    # path, gzip-compressed. The gzip header records neither the name nor
+    # the mtime, so that the same content always compresses to the same
+    # bytes, and the upload cache keeps working.
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+    try:
+        with path.open("rb") as src, gzip.GzipFile(
+            filename="", mode="wb", fileobj=spool, mtime=0
+        ) as dest:
+            shutil.copyfileobj(src, dest, 1 << 16)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+def bundle_member_name(path):
+    # Name of path in a bundle: the path as given, minus any anchor and
+    # .. components.
+    parts = path.parts[1:] if path.anchor else path.parts
+    return "/".join(part for part in parts if part != "..") or path.name
+
+
+def write_bundle(paths, fileobj):
+    # Writes the files at paths to fileobj as a ZIP archive, and returns
+    # the number of files. Raises UploadError if a file can't be read.
+    # (zipfile is comparatively slow to import, and rarely needed.)
+    import zipfile
+
+    names = set()
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for path in paths:
+            name = bundle_member_name(path)
+            stem, ext = os.path.splitext(name)
+            n = 1
+            while name in names:
+                n += 1
+                name = "%s-%d%s" % (stem, n, ext)
+            names.add(name)
+            if not path.is_file():
+                raise UploadError("%s: does not exist" % path)
+            try:
+                archive.write(str(path), name)
+            except OSError as e:
+                raise UploadError("%s: %s" % (path, e))
+            logger.debug("%s: added to bundle as %s", path, name)
+    return len(names)
+
+
+def optimize_image(src, dest, max_dimension=None, strip_metadata=False):
+    """Re-encodes a PNG or JPEG image at src to dest, smaller if possible.
+
+    PNGs are recompressed losslessly; JPEGs are re-encoded progressive
+    with optimized Huffman tables, keeping the original quantization
+    tables unless the image is resized. Images larger than max_dimension
+    (in either direction) are scaled down. With strip_metadata, EXIF data
+    (after applying its orientation) and text chunks are dropped; color
+    profiles are always kept. JPEGs that aren't resized are stripped
+    without re-encoding instead, keeping just the EXIF orientation (see
+    strip_jpeg_metadata).
+
+    Returns whether the image was resized, or None if src is not a still
+    PNG or JPEG image, in which case dest is not written. Runs in
+    ImageOptimizer's worker processes.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as im:
+        fmt = im.format
+        if fmt not in ("PNG", "JPEG") or getattr(im, "is_animated", False):
+            return None
+        resized = bool(max_dimension and max(im.size) > max_dimension)
+        if fmt == "JPEG" and strip_metadata and not resized:
+            orientation = im.getexif().get(0x0112)
+            with open(src, "rb") as fp:
+                data = strip_jpeg_metadata(fp.read(), orientation)
+            with open(dest, "wb") as fp:
+                fp.write(data)
+            return False
+        options = {"optimize": True}
+        icc_profile = im.info.get("icc_profile")
+        if icc_profile:
+            options["icc_profile"] = icc_profile
+        if fmt == "JPEG":
+            options["progressive"] = True
+            # Quantization tables can only be kept for an unmodified image.
+            options["quality"] = "keep" if not resized else 90
+            if not strip_metadata and "exif" in im.info:
+                options["exif"] = im.info["exif"]
+        elif not strip_metadata and getattr(im, "text", None):
+            from PIL import PngImagePlugin
+
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in im.text.items():
+                pnginfo.add_text(key, value)
+            options["pnginfo"] = pnginfo
+        out = im
+        if strip_metadata:
+            out = ImageOps.exif_transpose(out)
+        if resized:
+            out = out.copy() if out is im else out
+            out.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        out.save(str(dest), fmt, **options)
+    return resized
+
+
+def strip_jpeg_metadata(data, orientation=None):
+    """Drops metadata segments from JPEG data, without re-encoding.
+
+    EXIF, XMP, IPTC and other application segments and comments are
+    dropped; JFIF (APP0), color profile (APP2) and Adobe (APP14) segments,
+    which affect how the image is decoded, are kept, as is everything from
+    the first scan on. If orientation is an EXIF orientation other than 1,
+    a minimal EXIF segment holding just that is put back, so that the image
+    is displayed the same way. Raises ValueError on malformed data.
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG image")
+    segments = [data[:2]]
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            raise ValueError("malformed JPEG image")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte.
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of scan.
+            segments.append(data[pos:])
+            break
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers.
+            segments.append(data[pos : pos + 2])
+            pos += 2
+            continue
+        end = pos + 2 + struct.unpack(">H", data[pos + 2 : pos + 4])[0]
+        metadata = marker == 0xFE or (
+            0xE1 <= marker <= 0xEF and marker not in (0xE2, 0xEE)
+        )
+        if not metadata:
+            segments.append(data[pos:end])
+        pos = end
+    if orientation and orientation != 1:
+        # Big-endian TIFF header and a single IFD with one SHORT entry.
+        tiff = b"MM\x00\x2a" + struct.pack(
+            ">IHHHIHHI", 8, 1, 0x0112, 3, 1, orientation, 0, 0
+        )
+        payload = b"Exif\x00\x00" + tiff
+        segment = b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+        # After the JFIF segment, which must come first.
+        segments.insert(2 if segments[1][:2] == b"\xff\xe0" else 1, segment)
+    return b"".join(segments)
+
+
+class IssuePageParser:
+    """Extracts the login and the first CSRF token from an issue page.
+
+    The token is the same one found by
+    document.querySelector('input[data-csrf=true]') in a browser. Wraps
+    an html.parser.HTMLParser, imported only when needed.
+    """
+
+    def __init__(self):
+        import html.parser
+
+        self.user_login = None
+        self.token = None
+        self._parser = html.parser.HTMLParser()
+        self._parser.handle_starttag = self.handle_starttag
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "meta" and attrs.get("name") == "user-login":
+            self.user_login = attrs.get("content")
+        elif tag == "input" and attrs.get("data-csrf") == "true":
+            if self.token is None:
+                self.token = attrs.get("value")
+
+
+def merge_set_cookie_headers(cookies, headers, domain):
+    # Updates a list of WebDriver-style cookie dicts in place with the
+    # Set-Cookie headers of a response from domain.
+    import email.utils
+    import http.cookies
+
+    for header in headers.getlist("Set-Cookie"):
+        jar = http.cookies.SimpleCookie()
+        try:
+            jar.load(header)
+        except http.cookies.CookieError:
+            continue
+        for name, morsel in jar.items():
+            cookies[:] = [c for c in cookies if c.get("name") != name]
+            if morsel["max-age"] == "0" or not morsel.value:
+                continue
+            cookie = {
+                "name": name,
+                "value": morsel.value,
+                "domain": morsel["domain"] or domain,
+                "path": morsel["path"] or "/",
+                "secure": bool(morsel["secure"]),
+                "httpOnly": bool(morsel["httponly"]),
+            }
+            # Expiry (seconds since the epoch) as WebDriver reports it.
+            try:
+                if morsel["max-age"]:
+                    cookie["expiry"] = int(time.time()) + int(morsel["max-age"])
+                elif morsel["expires"]:
+                    cookie["expiry"] = int(
+                        email.utils.parsedate_to_datetime(morsel["expires"]).timestamp()
+                    )
+            except (TypeError, ValueError, IndexError):
+                pass
+            cookies.append(cookie)
+
+
+class UploadCache:
+    """Persistent index of uploaded assets, keyed by content.
+
+    Keys are (sha256, size, content_type, repository_id) tuples. The index
+    is an SQLite database, which takes care of locking, so a cache can be
+    shared by concurrent ghuc processes. Connections are short-lived and
+    not shared across threads.
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, max_age=CACHE_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    def _connect(self):
+        import sqlite3
+
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS assets ("
+            "sha256 TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "content_type TEXT NOT NULL, "
+            "repository_id INTEGER NOT NULL, "
+            "asset_url TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "PRIMARY KEY (sha256, size, content_type, repository_id))"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS assets_last_used ON assets (last_used)"
+        )
+        return conn
+
+    def lookup(self, key):
+        import sqlite3
+
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    now = time.time()
+                    conn.execute(
+                        "DELETE FROM assets WHERE created < ?", (now - self.max_age,)
+                    )
+                    row = conn.execute(
+                        "SELECT asset_url FROM assets WHERE sha256 = ? AND size = ? "
+                        "AND content_type = ? AND repository_id = ?",
+                        key,
+                    ).fetchone()
+                    if row is None:
+                        return None
+                    conn.execute(
+                        "UPDATE assets SET last_used = ? WHERE sha256 = ? AND size = ? "
+                        "AND content_type = ? AND repository_id = ?",
+                        (now,) + key,
+                    )
+                    return row[0]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("upload cache unavailable: %s", e)
+            return None
+
+    def store(self, key, asset_url):
+        import sqlite3
+
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    now = time.time()
+                    conn.execute(
+                        "INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        key + (asset_url, now, now),
+                    )
+                    # Evict least recently used entries beyond the size limit.
+                    conn.execute(
+                        "DELETE FROM assets WHERE rowid NOT IN "
+                        "(SELECT rowid FROM assets ORDER BY last_used DESC LIMIT ?)",
+                        (self.max_entries,),
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("upload cache unavailable: %s", e)
+
+    def invalidate(self, key):
+        import sqlite3
+
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "DELETE FROM assets WHERE sha256 = ? AND size = ? "
+                        "AND content_type = ? AND repository_id = ?",
+                        key,
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("upload cache unavailable: %s", e)
+
+
+class UploadJournal:
+    """Append-only log of a batch of uploads, for resuming interrupted runs.
+
+    The journal is a file of JSON lines: {"path": ..., "started": true}
+    when an upload starts, and {"path", "mtime", "size", "url", "mime",
+    "sha256"} when it finishes (mtime and size being those of the file
+    uploaded). Entries are flushed as they are written, so they survive
+    the process being killed, and synced to disk in batches (see
+    JOURNAL_SYNC_INTERVAL). On open, finished entries are indexed by path,
+    so that lookup can tell whether a file was already uploaded (and is
+    unchanged) with a single stat. A torn last line is ignored. close
+    compacts the journal down to the latest finished entry of each path.
+    Thread-safe.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        # Absolute path -> latest finished entry.
+        self.finished = collections.OrderedDict()
+        interrupted = set()
+        try:
+            with self.path.open(encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        key = entry["path"]
+                    except (ValueError, TypeError, KeyError):
+                        continue
+                    if entry.get("started"):
+                        interrupted.add(key)
+                    elif entry.get("url"):
+                        interrupted.discard(key)
+                        self.finished.pop(key, None)
+                        self.finished[key] = entry
+        except FileNotFoundError:
+            pass
+        if interrupted:
+            logger.info(
+                "%s: %d uploads interrupted in a previous run will be retried",
+                self.path,
+                len(interrupted),
+            )
+        logger.debug("%s: %d finished uploads", self.path, len(self.finished))
+        self._lock = threading.Lock()
+        self._fp = self.path.open("a", encoding="utf-8")
+        self._synced_at = time.monotonic()
+        self._unsynced = 0
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(str(path))
+
+    def lookup(self, path):
+        # Returns the journaled entry of path if it was uploaded and hasn't
+        # changed since, or None.
+        entry = self.finished.get(self._key(path))
+        if entry is None:
+            return None
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        if (st.st_mtime, st.st_size) != (entry.get("mtime"), entry.get("size")):
+            return None
+        return entry
+
+    def start(self, path):
+        # Returns the stat of path to pass to finish, or None if it can't
+        # be stat'ed (in which case the upload is bound to fail anyway).
+        # Taken before the upload starts, so that a file modified while
+        # uploading doesn't look uploaded later on.
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        self._append({"path": self._key(path), "started": True})
+        return st
+
+    def finish(self, path, result, st):
+        # Records a successful upload (an UploadResult) of path as it was
+        # when the upload started (st, from start).
+        if st is None:
+            return
+        entry = collections.OrderedDict(
+            [
+                ("path", self._key(path)),
+                ("mtime", st.st_mtime),
+                ("size", st.st_size),
+                ("url", result.url),
+                ("mime", result.mime),
+                ("sha256", result.sha256),
+            ]
+        )
+        self._append(entry)
+        with self._lock:
+            self.finished.pop(entry["path"], None)
+            self.finished[entry["path"]] = entry
+
+    def _append(self, entry):
+        with self._lock:
+            self._fp.write(json.dumps(entry) + "\n")
+            self._fp.flush()
+            self._unsynced += 1
+            if (
+                self._unsynced >= JOURNAL_SYNC_ENTRIES
+                or time.monotonic() - self._synced_at >= JOURNAL_SYNC_INTERVAL
+            ):
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._fp.fileno())
+        self._synced_at = time.monotonic()
+        self._unsynced = 0
+
+    def close(self, compact=True):
+        with self._lock:
+            if self._fp.closed:
+                return
+            self._sync()
+            self._fp.close()
+            if compact:
+                # Keep the mode of the user's file, not the private default.
+                try:
+                    mode = os.stat(str(self.path)).st_mode & 0o7777
+                except OSError:
+                    mode = None
+                write_file_atomically(
+                    self.path,
+                    "".join(
+                        json.dumps(entry) + "\n" for entry in self.finished.values()
+                    ),
+                    mode=0o666 if mode is None else mode,
+                )
+                if mode is not None:
+                    # The umask may have masked bits the file had.
+                    os.chmod(str(self.path), mode)
+
+
+class UploadPolicy:
+    """Client-side table of acceptable MIME types and their size limits.
+
+    Files are checked against the table before /upload/policies/assets is
+    asked, so that unsupported or oversized files fail fast. Types not in
+    the table are attempted; types the server rejects are learned with
+    reject, and persisted (with the time they were learned) to a JSON file
+    shared by all ghuc processes. The file may also be edited by hand:
+
+        {
+          "limits": {"video/mp4": 10485760, "image/png": null},
+          "rejected": {"image/webp": 1554076800.0}
+        }
+
+    where limits override DEFAULT_SIZE_LIMITS (null meaning no limit), and
+    rejected entries expire after max_age seconds.
+    """
+
+    def __init__(self, path, max_age=POLICY_REJECTION_MAX_AGE):
+        self.path = pathlib.Path(path)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        overrides, self.rejected = self._load()
+        self.limits = collections.OrderedDict(DEFAULT_SIZE_LIMITS)
+        self.limits.update(overrides)
+
+    def _load(self):
+        # Returns (limits, rejected) from the file.
+        try:
+            with self.path.open() as fp:
+                data = json.load(fp)
+            limits = data.get("limits", {})
+            rejected = data.get("rejected", {})
+            if not (
+                isinstance(limits, dict)
+                and isinstance(rejected, dict)
+                and all(v is None or isinstance(v, int) for v in limits.values())
+                and all(isinstance(v, (int, float)) for v in rejected.values())
+            ):
+                raise ValueError("malformed policy")
+            return limits, rejected
+        except FileNotFoundError:
+            return {}, {}
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning("%s: ignoring upload policy: %s", self.path, e)
+            return {}, {}
+
+    def check(self, path, content_type, size):
+        # Raises UploadError if the file is known to be unacceptable.
+        with self._lock:
+            rejected_at = self.rejected.get(content_type)
+            limit = self.limits.get(content_type)
+        if rejected_at is not None and time.time() - rejected_at < self.max_age:
+            raise UploadError("%s: unsupported MIME type %s" % (path, content_type))
+        if limit is not None and size > limit:
+            raise UploadError(
+                "%s: file too large (%d bytes; %s files are limited to %d bytes)"
+                % (path, size, content_type, limit)
+            )
+
+    def reject(self, content_type):
+        # Records content_type as unsupported, in memory and on disk.
+        with self._lock:
+            now = time.time()
+            self.rejected[content_type] = now
+            # Merge with entries learned by other processes in the meantime.
+            limits, rejected = self._load()
+            rejected[content_type] = now
+            try:
+                write_file_atomically(
+                    self.path,
+                    json.dumps({"limits": limits, "rejected": rejected}, indent=2)
+                    + "\n",
+                )
+            except OSError as e:
+                logger.warning("%s: failed to save upload policy: %s", self.path, e)
+            else:
+                logger.debug("learned that %s is not supported", content_type)
+
+
+class ImageOptimizer:
+    """Optional pre-upload stage that shrinks PNG and JPEG images.
+
+    Images are re-encoded (see optimize_image) in a pool of worker
+    processes, so that several upload threads can have images encoded in
+    parallel while others are busy with the network. Results are cached
+    in cache_dir as <key>/<original name>, where key is derived from the
+    SHA-256 digest of the source and the settings, so repeated runs don't
+    re-encode and uploads keep their original names. Re-encoded images
+    that turn out no smaller than the original (and aren't resized or
+    stripped of metadata) are discarded in favor of the original. Cache
+    entries unused for max_age seconds are evicted, as are the least
+    recently used ones beyond max_entries, once per ImageOptimizer.
+
+    Needs Pillow; raises ValueError if it's not available.
+    """
+
+    CONTENT_TYPES = ("image/png", "image/jpeg")
+    # Part of cache keys; bumped when the output for given settings changes.
+    VERSION = 2
+
+    def __init__(
+        self,
+        cache_dir,
+        max_dimension=None,
+        strip_metadata=False,
+        processes=None,
+        max_entries=OPTIMIZED_CACHE_MAX_ENTRIES,
+        max_age=OPTIMIZED_CACHE_MAX_AGE,
+    ):
+        if importlib.util.find_spec("PIL") is None:
+            raise ValueError("image optimization requires Pillow (pip install Pillow)")
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_dimension = max_dimension
+        self.strip_metadata = strip_metadata
+        self.processes = processes
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._pruned = False
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                options = {}
+                # Forking a process that runs threads (upload workers,
+                # credential refreshes) can deadlock the child, so workers
+                # are started fresh where that's configurable (3.7+).
+                if sys.version_info >= (3, 7):
+                    import multiprocessing
+
+                    methods = multiprocessing.get_all_start_methods()
+                    options["mp_context"] = multiprocessing.get_context(
+                        "forkserver" if "forkserver" in methods else "spawn"
+                    )
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes, **options
+                )
+            return self._executor
+
+    def _key(self, digest):
+        settings = "%s:%s:%s:%d" % (
+            digest,
+            self.max_dimension,
+            self.strip_metadata,
+            self.VERSION,
+        )
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+    def prune(self):
+        # Evicts expired and excess cache entries. The mtime of an entry's
+        # directory is its last use.
+        try:
+            entries = [
+                (entry.stat().st_mtime, entry)
+                for entry in self.cache_dir.iterdir()
+                if entry.is_dir()
+            ]
+        except OSError:
+            return
+        entries.sort(reverse=True)
+        cutoff = time.time() - self.max_age
+        evicted = [
+            entry
+            for i, (mtime, entry) in enumerate(entries)
+            if mtime < cutoff or i >= self.max_entries
+        ]
+        for entry in evicted:
+            shutil.rmtree(str(entry), ignore_errors=True)
+        if evicted:
+            logger.debug("evicted %d optimized images from cache", len(evicted))
+
+    def optimize(self, path, content_type, digest=None):
+        # Returns the path of the file to upload in place of path: the
+        # optimized image, or path itself.
+        if content_type not in self.CONTENT_TYPES:
+            return path
+        with self._executor_lock:
+            prune, self._pruned = not self._pruned, True
+        if prune:
+            self.prune()
+        digest = digest or sha256_file(path)
+        directory = self.cache_dir / self._key(digest)
+        dest = directory / path.name
+        # A marker for sources that can't be made any smaller.
+        original_marker = directory / ".original"
+        if dest.is_file() or original_marker.exists():
+            try:
+                os.utime(str(directory))
+            except OSError:
+                pass
+            if dest.is_file():
+                logger.debug("%s: optimized image cached at %s", path, dest)
+                return dest
+            return path
+
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            dir=str(directory), prefix=".tmp-", suffix=path.suffix
+        )
+        os.close(fd)
+        try:
+            future = self._get_executor().submit(
+                optimize_image,
+                str(path),
+                temp_path,
+                max_dimension=self.max_dimension,
+                strip_metadata=self.strip_metadata,
+            )
+            resized = future.result()
+            if resized is not None and (
+                resized
+                or self.strip_metadata
+                or os.path.getsize(temp_path) < path.stat().st_size
+            ):
+                os.replace(temp_path, str(dest))
+                logger.debug(
+                    "%s: optimized to %d bytes (from %d)",
+                    path,
+                    dest.stat().st_size,
+                    path.stat().st_size,
+                )
+                return dest
+            original_marker.touch()
+            return path
+        except Exception as e:
+            # Broken image, worker crash, etc.: upload the original.
+            logger.warning("%s: failed to optimize image: %s", path, e)
+            return path
+        finally:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class CredentialStore:
+    """Cookies and token persisted in a directory, shared between processes.
+
+    Files are replaced atomically, so readers never see a torn file, and
+    every save bumps a generation counter. An advisory lock on a separate
+    lock file serializes refreshes across processes: a process that finds
+    its credentials stale takes the lock, and if the generation has moved
+    on in the meantime, picks up the credentials saved by whoever held the
+    lock instead of refreshing them again.
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.cookie_file = self.directory / "cookies"
+        self.token_file = self.directory / "token"
+        self.generation_file = self.directory / "generation"
+        self.lifetimes_file = self.directory / "token_lifetimes"
+        self.lock_file = self.directory / "credentials.lock"
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not _try_lock_file(fd, shared):
+                logger.info(
+                    "waiting for another ghuc process to refresh credentials..."
+                )
+                _lock_file(fd, shared)
+            try:
+                yield
+            finally:
+                _unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    def generation(self):
+        try:
+            with self.generation_file.open() as fp:
+                return int(fp.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def load(self):
+        # Returns (cookies, token, generation). cookies is [] and token is
+        # None if missing or unreadable.
+        try:
+            logger.debug("loading token from %s ...", self.token_file)
+            with self.token_file.open() as fp:
+                token = fp.read().strip() or None
+        except OSError:
+            token = None
+        try:
+            logger.debug("loading cookies from %s ...", self.cookie_file)
+            with self.cookie_file.open() as fp:
+                cookies = json.load(fp)
+        except (OSError, ValueError):
+            cookies = []
+        return cookies, token, self.generation()
+
+    def save(self, cookies, token):
+        # Must be called with the lock held. Returns the new generation.
+        generation = self.generation() + 1
+        logger.debug("persisting cookies to %s ...", self.cookie_file)
+        self._write_atomically(self.cookie_file, json.dumps(cookies, indent=2) + "\n")
+        logger.debug("persisting token to %s ...", self.token_file)
+        self._write_atomically(self.token_file, token + "\n")
+        self._write_atomically(self.generation_file, "%d\n" % generation)
+        return generation
+
+    def issued_at(self):
+        # Time (time.time) the current cookies and token were saved, or
+        # None.
+        try:
+            return self.token_file.stat().st_mtime
+        except OSError:
+            return None
+
+    def token_lifetime(self):
+        # Expected lifetime of a token in seconds, or None if unknown: the
+        # shortest recorded with record_token_lifetime, since expiry is
+        # only noticed on the first use after the fact.
+        lifetimes = self._load_lifetimes()
+        return min(lifetimes) if lifetimes else None
+
+    def record_token_lifetime(self, seconds):
+        lifetimes = self._load_lifetimes()[-(TOKEN_LIFETIME_SAMPLES - 1) :]
+        lifetimes.append(seconds)
+        self._write_atomically(self.lifetimes_file, json.dumps(lifetimes) + "\n")
+
+    def _load_lifetimes(self):
+        try:
+            with self.lifetimes_file.open() as fp:
+                lifetimes = json.load(fp)
+            return [float(t) for t in lifetimes if t > 0]
+        except (OSError, ValueError, TypeError):
+            return []
+
+    def _write_atomically(self, path, content):
+        write_file_atomically(path, content)
+        secure_file_permissions(path)
+
+
+class CredentialProfile:
+    """A GitHub account's credentials, as loaded into an Uploader.
+
+    The default profile (name None) keeps its CredentialStore in the data
+    directory itself, and reads GITHUB_USERNAME, GITHUB_PASSWORD and
+    GITHUB_TOTP_SECRET; profile NAME keeps its store in profiles/NAME, and
+    reads the same variables suffixed with _NAME (uppercased, with dashes
+    turned into underscores), e.g. GITHUB_PASSWORD_WORK.
+
+    Besides the credentials, a profile tracks what Uploader needs to
+    spread uploads across profiles: uploads in flight, whether a refresh
+    is underway, and until when the account is throttled. All of that is
+    guarded by the Uploader; the credentials by lock.
+    """
+
+    def __init__(self, data_dir, name=None):
+        if name is not None and not re.match(r"^[A-Za-z0-9_-]+$", name):
+            raise ValueError(
+                "invalid profile name %r; use letters, digits, - and _" % name
+            )
+        self.name = name
+        directory = pathlib.Path(data_dir)
+        if name is not None:
+            directory = directory / "profiles" / name
+        directory.mkdir(exist_ok=True, parents=True)
+        self.store = CredentialStore(directory)
+        # refreshed_at is the time (time.monotonic) of the last refresh,
+        # or None. Used to make sure we don't blame /upload/policies/assets
+        # failure on credentials we just refreshed; see
+        # FRESH_CREDENTIALS_PERIOD.
+        self.refreshed_at = None
+        self.cookies = []
+        self.cookie_header = None
+        self.token = None
+        # Generation (see CredentialStore) of the credentials in memory.
+        self.generation = 0
+        self.loaded = False
+        # Serializes loads and refreshes across upload threads, so that a
+        # stale token discovered by several concurrent uploads only
+        # triggers one browser session. (The store's lock does the same
+        # across processes.)
+        self.lock = threading.RLock()
+        self.in_flight = 0
+        self.refreshing = False
+        self.throttled_until = 0.0
+        # threading.Timer for the next refresh ahead of expiry, or None.
+        self.refresh_timer = None
+
+    @property
+    def label(self):
+        return self.name or "default"
+
+    def env_var(self, name):
+        if self.name is None:
+            return name
+        return "%s_%s" % (name, self.name.upper().replace("-", "_"))
+
+    def available(self, now):
+        return not self.refreshing and self.throttled_until <= now
+
+
+if os.name == "nt":
+    import msvcrt
+
+    # msvcrt has no shared locks; all locks are exclusive.
+
+    def _try_lock_file(fd, shared):
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _lock_file(fd, shared):
+        # LK_LOCK only retries for 10 seconds.
+        while not _try_lock_file(fd, shared):
+            time.sleep(1)
+
+    def _unlock_file(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _try_lock_file(fd, shared):
+        try:
+            fcntl.flock(
+                fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+            )
+            return True
+        except BlockingIOError:
+            return False
+
+    def _lock_file(fd, shared):
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def _unlock_file(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class MultipartFileBody(io.RawIOBase):
+    """Streaming multipart/form-data body with a trailing file field.
+
+    Produces the same encoding as urllib3.encode_multipart_formdata, but
+    the file content is read from disk in chunks as the body is consumed,
+    instead of being loaded into memory (twice) up front. The total length
+    is known in advance and available as content_length.
+
+    Seekable so that urllib3 can rewind the body when retrying. The SHA-256
+    digest of the file content is computed on the fly, and available as
+    sha256 once all of it has been read. path may also be a seekable binary
+    file object, which is left open.
+    """
+
+    def __init__(self, fields, file_field, filename, path, throttle=None):
+        super().__init__()
+        # Optional TokenBucket capping the rate at which file content is
+        # read (in bytes per second), and thus sent.
+        self._throttle = throttle
+        self.boundary = choose_boundary()
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        head = io.BytesIO()
+        for name, value in fields.items():
+            self._write_part_header(head, RequestField.from_tuples(name, value))
+            if isinstance(value, int):
+                value = str(value)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            head.write(value)
+            head.write(b"\r\n")
+        self._write_part_header(
+            head, RequestField.from_tuples(file_field, (filename, b""))
+        )
+        self._head = head.getvalue()
+        self._tail = ("\r\n--%s--\r\n" % self.boundary).encode("utf-8")
+        self._filename = filename
+        if hasattr(path, "read"):
+            self._fp = path
+            self._owns_fp = False
+            self._fp.seek(0, io.SEEK_END)
+            self._file_size = self._fp.tell()
+        else:
+            self._fp = open(str(path), "rb")
+            self._owns_fp = True
+            self._file_size = os.fstat(self._fp.fileno()).st_size
+        self._file_end = len(self._head) + self._file_size
+        self.content_length = self._file_end + len(self._tail)
+        self._pos = 0
+        self._hash = hashlib.sha256()
+        # Length of the prefix of the file content fed to _hash.
+        self._hashed = 0
+
+    def _write_part_header(self, buf, field):
+        buf.write(("--%s\r\n" % self.boundary).encode("utf-8"))
+        buf.write(field.render_headers().encode("utf-8"))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.content_length
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        view = memoryview(b)
+        pos = self._pos
+        head_size = len(self._head)
+        if pos < head_size:
+            n = min(len(view), head_size - pos)
+            view[:n] = self._head[pos : pos + n]
+        elif pos < self._file_end:
+            n = min(len(view), self._file_end - pos)
+            offset = pos - head_size
+            self._fp.seek(offset)
+            if hasattr(self._fp, "readinto"):
+                n = self._fp.readinto(view[:n])
+            else:
+                # E.g. SpooledTemporaryFile before Python 3.11.
+                data = self._fp.read(n)
+                n = len(data)
+                view[:n] = data
+            if not n:
+                raise OSError("%s: file truncated during upload" % self._filename)
+            if offset == self._hashed:
+                self._hash.update(view[:n])
+                self._hashed += n
+            if self._throttle:
+                self._throttle.consume(n)
+        elif pos < self.content_length:
+            n = min(len(view), self.content_length - pos)
+            start = pos - self._file_end
+            view[:n] = self._tail[start : start + n]
+        else:
+            n = 0
+        self._pos += n
+        return n
+
+    @property
+    def sha256(self):
+        # Hex digest of the file content, or None if not read in full yet.
+        if self._hashed < self._file_size:
+            return None
+        return self._hash.hexdigest()
+
+    def close(self):
+        if not self.closed and self._owns_fp:
+            self._fp.close()
+        super().close()
+
+
+class Metrics:
+    """Thread-safe upload metrics: per-phase latency histograms and counters.
+
+    Phases (mime, hash, optimize, compress, cache, policy, transfer, register,
+    verify, refresh, and upload for the whole of Uploader.upload) are timed with
+    the timer context manager; counters (uploads by result, uploaded
+    bytes, retries, phase retries and the bytes they wasted, credential
+    refreshes by method, verifications by result, uploads and bytes by
+    profile) are bumped with count. Connection reuse stats are read from
+    the urllib3 pools of the PoolManager passed to summary, prometheus_text or
+    as_dict.
+    """
+
+    PHASES = (
+        "upload",
+        "mime",
+        "hash",
+        "optimize",
+        "compress",
+        "cache",
+        "policy",
+        "transfer",
+        "register",
+        "verify",
+        "refresh",
+    )
+
+    COUNTERS = collections.OrderedDict(
+        [
+            ("uploads", ("result", "Finished uploads, by result.")),
+            ("uploaded_bytes", (None, "Bytes of file content uploaded.")),
+            ("retries", (None, "Policy requests retried with refreshed credentials.")),
+            (
+                "phase_retries",
+                ("phase", "Upload phases retried after transient failures, by phase."),
+            ),
+            ("wasted_bytes", (None, "Bytes sent in failed transfers.")),
+            ("throttled", ("phase", "Requests throttled by the server, by phase.")),
+            (
+                "credential_refreshes",
+                (
+                    "method",
+                    "Credential refreshes, by method (http, browser, shared, ahead).",
+                ),
+            ),
+            (
+                "verifications",
+                ("result", "Uploads verified by download, by result."),
+            ),
+            ("profile_uploads", ("profile", "Files uploaded, by credential profile.")),
+            ("profile_bytes", ("profile", "Bytes uploaded, by credential profile.")),
+        ]
+    )
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # phase -> [count, sum, max, per-bucket counts...]
+        self.histograms = collections.OrderedDict()
+        # (name, label value or None) -> value
+        self.counters = collections.Counter()
+        # For throughput in summary.
+        self.started_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        # Yields a list that receives the elapsed time when done. Failed
+        # phases are recorded too; slow failures are worth seeing.
+        elapsed = []
+        start = time.monotonic()
+        try:
+            yield elapsed
+        finally:
+            elapsed.append(time.monotonic() - start)
+            self.observe(phase, elapsed[0])
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = [0, 0.0, 0.0] + [0] * len(self.buckets)
+                self.histograms[phase] = histogram
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[3 + i] += 1
+
+    def count(self, name, n=1, label=None):
+        with self._lock:
+            self.counters[(name, label)] += n
+
+    def _snapshot(self):
+        with self._lock:
+            histograms = collections.OrderedDict(
+                (phase, list(self.histograms[phase]))
+                for phase in sorted(self.histograms, key=self._phase_order)
+            )
+            return histograms, collections.Counter(self.counters)
+
+    def _phase_order(self, phase):
+        try:
+            return (self.PHASES.index(phase), phase)
+        except ValueError:
+            return (len(self.PHASES), phase)
+
+    def connection_stats(self, pool_manager):
+        # Returns [(origin, connections, requests, prewarmed, hits, misses)]:
+        # connections opened (prewarmed of them ahead of time by
+        # Uploader.prewarm) and requests sent. Pool misses are connections
+        # opened on demand, i.e. requests that paid for a handshake; pool
+        # hits are requests served on a connection that was already open.
+        stats = []
+        if pool_manager is None:
+            return stats
+        with self._lock:
+            prewarmed = {
+                label: value
+                for (name, label), value in self.counters.items()
+                if name == "prewarmed_connections"
+            }
+        for key in pool_manager.pools.keys():
+            try:
+                pool = pool_manager.pools[key]
+            except KeyError:
+                # Evicted in the meantime.
+                continue
+            origin = pool_origin(pool)
+            warm = prewarmed.get(origin, 0)
+            misses = max(0, pool.num_connections - warm)
+            hits = max(0, pool.num_requests - misses)
+            stats.append(
+                (origin, pool.num_connections, pool.num_requests, warm, hits, misses)
+            )
+        return sorted(stats)
+
+    def as_dict(self, pool_manager=None):
+        histograms, counters = self._snapshot()
+        return {
+            "phases": collections.OrderedDict(
+                (
+                    phase,
+                    {
+                        "count": h[0],
+                        "sum": h[1],
+                        "max": h[2],
+                        "buckets": collections.OrderedDict(
+                            zip(map(str, self.buckets), h[3:])
+                        ),
+                    },
+                )
+                for phase, h in histograms.items()
+            ),
+            "counters": collections.OrderedDict(
+                (name if label is None else "%s{%s}" % (name, label), value)
+                for (name, label), value in sorted(
+                    counters.items(), key=lambda item: (item[0][0], item[0][1] or "")
+                )
+            ),
+            "connections": collections.OrderedDict(
+                (
+                    stats[0],
+                    collections.OrderedDict(
+                        zip(
+                            (
+                                "connections",
+                                "requests",
+                                "prewarmed",
+                                "pool_hits",
+                                "pool_misses",
+                            ),
+                            stats[1:],
+                        )
+                    ),
+                )
+                for stats in self.connection_stats(pool_manager)
+            ),
+        }
+
+    def prometheus_text(self, pool_manager=None):
+        # Prometheus text exposition format, as read by e.g. node-exporter's
+        # textfile collector. Counter families are named with their _total
+        # suffix, like their samples. (Not OpenMetrics, which requires
+        # counter families to be named without it.)
+        histograms, counters = self._snapshot()
+        lines = []
+
+        def family(name, type_, help_):
+            lines.append("# TYPE %s %s" % (name, type_))
+            lines.append("# HELP %s %s" % (name, help_))
+
+        def sample(name, labels, value):
+            if labels:
+                name += "{%s}" % ",".join(
+                    '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in labels
+                )
+            lines.append("%s %s" % (name, value))
+
+        name = "ghuc_phase_duration_seconds"
+        family(name, "histogram", "Time spent in each upload phase.")
+        for phase, h in histograms.items():
+            for bound, n in zip(self.buckets, h[3:]):
+                sample(name + "_bucket", [("phase", phase), ("le", float(bound))], n)
+            sample(name + "_bucket", [("phase", phase), ("le", "+Inf")], h[0])
+            sample(name + "_sum", [("phase", phase)], repr(h[1]))
+            sample(name + "_count", [("phase", phase)], h[0])
+
+        for counter, (label_name, help_) in self.COUNTERS.items():
+            name = "ghuc_%s_total" % counter
+            family(name, "counter", help_)
+            for (n, label), value in sorted(counters.items(), key=str):
+                if n == counter:
+                    labels = [(label_name, label)] if label_name else []
+                    sample(name, labels, value)
+
+        connection_stats = self.connection_stats(pool_manager)
+        for key, help_, index in (
+            ("connections", "HTTP connections opened, by origin.", 1),
+            ("requests", "HTTP requests sent, by origin.", 2),
+            ("prewarmed_connections", "HTTP connections opened ahead of time.", 3),
+            ("pool_hits", "HTTP requests sent on an already open connection.", 4),
+            ("pool_misses", "HTTP connections opened on demand.", 5),
+        ):
+            name = "ghuc_http_%s_total" % key
+            family(name, "counter", help_)
+            for stats in connection_stats:
+                sample(name, [("origin", stats[0])], stats[index])
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self, pool_manager=None):
+        histograms, counters = self._snapshot()
+        lines = [
+            "%-10s %7s %10s %10s %10s"
+            % ("phase", "count", "total(s)", "mean(ms)", "max(ms)")
+        ]
+        for phase, h in histograms.items():
+            lines.append(
+                "%-10s %7d %10.3f %10.1f %10.1f"
+                % (phase, h[0], h[1], h[1] / h[0] * 1000, h[2] * 1000)
+            )
+        lines.append(
+            "uploads: %d succeeded, %d cached, %d failed; %d bytes uploaded"
+            % (
+                counters[("uploads", "success")],
+                counters[("uploads", "cached")],
+                counters[("uploads", "failure")],
+                counters[("uploaded_bytes", None)],
+            )
+        )
+        if counters[("uploads", "journaled")]:
+            lines.append(
+                "journal: %d uploads skipped" % counters[("uploads", "journaled")]
+            )
+        if any(name == "verifications" for name, _ in counters):
+            lines.append(
+                "verifications: %d ok, %d mismatched, %d failed"
+                % (
+                    counters[("verifications", "ok")],
+                    counters[("verifications", "mismatch")],
+                    counters[("verifications", "failure")],
+                )
+            )
+        refreshes = sorted(
+            (label, value)
+            for (name, label), value in counters.items()
+            if name == "credential_refreshes"
+        )
+        lines.append(
+            "credential refreshes: %d%s; retries: %d"
+            % (
+                sum(value for _, value in refreshes),
+                (
+                    " (%s)" % ", ".join("%s: %d" % r for r in refreshes)
+                    if refreshes
+                    else ""
+                ),
+                counters[("retries", None)],
+            )
+        )
+        phase_retries = sorted(
+            (label, value)
+            for (name, label), value in counters.items()
+            if name == "phase_retries"
+        )
+        if phase_retries:
+            lines.append(
+                "phase retries: %d (%s); %d bytes sent in failed transfers"
+                % (
+                    sum(value for _, value in phase_retries),
+                    ", ".join("%s: %d" % r for r in phase_retries),
+                    counters[("wasted_bytes", None)],
+                )
+            )
+        profiles = sorted(
+            label for (name, label) in counters if name == "profile_uploads"
+        )
+        if len(profiles) > 1:
+            elapsed = max(time.monotonic() - self.started_at, 1e-9)
+            for label in profiles:
+                uploads = counters[("profile_uploads", label)]
+                uploaded_bytes = counters[("profile_bytes", label)]
+                lines.append(
+                    "profile %s: %d uploads, %d bytes (%.2f files/s, %.2f MB/s)"
+                    % (
+                        label,
+                        uploads,
+                        uploaded_bytes,
+                        uploads / elapsed,
+                        uploaded_bytes / elapsed / 1e6,
+                    )
+                )
+        for (
+            origin,
+            connections,
+            requests,
+            prewarmed,
+            hits,
+            misses,
+        ) in self.connection_stats(pool_manager):
+            lines.append(
+                "%s: %d requests on %d connections (%d prewarmed); "
+                "pool hits: %d, misses: %d"
+                % (origin, requests, connections, prewarmed, hits, misses)
+            )
+        return "\n".join(lines)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date. Returns
+    # seconds, or None if missing or malformed.
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def policy_expiry(policy):
+    # Expiry time (time.time) of the S3 POST policy in an upload policy
+    # (base64-encoded JSON, with e.g. "expiration": "2019-04-06T19:56:41Z"),
+    # or None if unknown.
+    try:
+        document = json.loads(base64.b64decode(policy["form"]["policy"]).decode())
+        match = re.match(
+            r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)", document["expiration"]
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not match:
+        return None
+    import calendar
+
+    return calendar.timegm(tuple(int(g) for g in match.groups()))
+
+
+def backoff_delay(retry_after, attempt):
+    # Seconds to wait after being throttled for the attempt-th time: what
+    # the server asked for, or an exponential backoff.
+    if retry_after is None:
+        return min(2**attempt, THROTTLE_MAX_DELAY)
+    return retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter.
+
+    consume(n) takes n tokens, blocking until they are available; tokens
+    accrue at rate per second, up to burst. Callers may overdraw the
+    bucket, in which case they sleep off the debt, so n may exceed burst.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= n
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveLimiter:
+    """Caps the number of uploads in flight, adjusting the cap with AIMD.
+
+    Used as a context manager around the network part of each upload. The
+    cap starts at max_limit; it is halved when the server throttles us (in
+    which case no new uploads start until the Retry-After period, or an
+    exponential backoff, has passed), and cut by a fifth (at most once a
+    second) when the latency of policy and register requests rises well
+    above the baseline, i.e. the lowest latency seen, drifting slowly
+    upwards; see LATENCY_TOLERANCE. Otherwise it grows by 1/cap per
+    request, up to max_limit. If max_rate is given, uploads also start at
+    most max_rate times per second.
+    """
+
+    def __init__(self, max_limit, max_rate=None):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.baseline = None
+        self._decreased_at = 0.0
+        self._cond = threading.Condition()
+        self._rate_limiter = TokenBucket(max_rate, 1) if max_rate else None
+
+    def __enter__(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self._cond.wait(self.paused_until - now)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+        if self._rate_limiter:
+            self._rate_limiter.consume()
+        return self
+
+    def __exit__(self, *_):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def throttled(self, retry_after, attempt):
+        # Returns the delay before uploads resume.
+        retry_after = backoff_delay(retry_after, attempt)
+        with self._cond:
+            self.limit = max(1.0, self.limit / 2)
+            self._decreased_at = time.monotonic()
+            self.paused_until = max(self.paused_until, self._decreased_at + retry_after)
+            self._cond.notify_all()
+        logger.debug("concurrency cut to %d after throttling", int(self.limit))
+        return retry_after
+
+    def observe(self, seconds):
+        with self._cond:
+            if self.baseline is None or seconds < self.baseline:
+                self.baseline = seconds
+            else:
+                self.baseline += (seconds - self.baseline) * 0.01
+            now = time.monotonic()
+            if seconds > self.baseline * LATENCY_TOLERANCE + LATENCY_SLACK:
+                if now - self._decreased_at >= 1:
+                    self.limit = max(1.0, self.limit * 0.8)
+                    self._decreased_at = now
+                    logger.debug(
+                        "concurrency cut to %d after %.3fs request (baseline %.3fs)",
+                        int(self.limit),
+                        seconds,
+                        self.baseline,
+                    )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._cond.notify_all()
+
+
+def pool_origin(pool):
+    return "%s://%s:%s" % (pool.scheme, pool.host, pool.port)
+
+
+def make_http_client(proxy=None, maxsize=1):
+    # Size per-host pools to the number of concurrent requests to a host so
+    # that concurrent uploads don't discard connections when returning them
+    # to the pool.
+    common_http_options = dict(cert_reqs="CERT_REQUIRED", timeout=3.0, maxsize=maxsize)
+    if not proxy:
+        return PoolManager(**common_http_options)
+    elif proxy.startswith("http"):
+        return ProxyManager(proxy, **common_http_options)
+    elif proxy.startswith("socks"):
+        try:
+            from urllib3.contrib.socks import SOCKSProxyManager
+        except ImportError:
+            raise ValueError("your urllib3 installation does not support SOCKS proxies")
+        return SOCKSProxyManager(proxy, **common_http_options)
+    else:
+        raise ValueError("unrecognized proxy type %s" % proxy)
+
+
+class HTTP2Transport:
+    """HTTP/2 client for requests to GitHub, based on httpx.
+
+    Concurrent requests to an origin (through a given proxy) are
+    multiplexed over a single connection, rather than each taking a
+    connection of its own as with urllib3 over HTTP/1.1, which saves TCP,
+    proxy and TLS handshakes. Implements the part of urllib3's
+    PoolManager.request that Uploader uses for GitHub requests; responses
+    are read in full, and network errors are raised as urllib3 HTTPErrors.
+    Needs httpx[http2] (and httpx[socks] for SOCKS5 proxies); SOCKS4
+    proxies are not supported.
+    """
+
+    def __init__(self, proxy=None, timeout=3.0):
+        try:
+            import httpx
+        except ImportError:
+            httpx = None
+        if httpx is None or importlib.util.find_spec("h2") is None:
+            raise ValueError(
+                "the http2 transport needs httpx with HTTP/2 support; "
+                "install it with pip install 'httpx[http2]'"
+            )
+        if proxy and proxy.startswith("socks4"):
+            raise ValueError("the http2 transport does not support SOCKS4 proxies")
+        self._httpx = httpx
+        try:
+            self.client = httpx.Client(http2=True, proxy=proxy, timeout=timeout)
+        except ImportError as e:
+            # SOCKS support (socksio) missing.
+            raise ValueError("%s" % e)
+
+    def request(self, method, url, fields=None, headers=None, redirect=True):
+        headers = dict(headers or {})
+        body = None
+        if fields is not None:
+            # Encoded as urllib3 does for POST and PUT.
+            body, headers["Content-Type"] = encode_multipart_formdata(fields)
+        try:
+            r = self.client.request(
+                method, url, content=body, headers=headers, follow_redirects=redirect
+            )
+        except self._httpx.HTTPError as e:
+            raise HTTPError("%s %s: %s" % (method, url, e))
+        return HTTP2Response(r)
+
+    def connect(self, url):
+        # Opens the connection to the origin of url ahead of the first
+        # request; see Uploader.prewarm.
+        try:
+            self.client.request("HEAD", url)
+        except self._httpx.HTTPError as e:
+            logger.debug("%s: failed to prewarm connection: %s", url, e)
+
+    def clear(self):
+        # Closes all connections, like PoolManager.clear.
+        self.client.close()
+
+
+class HTTP2Response:
+    # The part of urllib3's HTTPResponse used for GitHub responses.
+
+    def __init__(self, response):
+        self.status = response.status_code
+        self.headers = HTTPHeaderDict()
+        for name, value in response.headers.multi_items():
+            self.headers.add(name, value)
+        self.data = response.content
+
+
+# Upload phases with a worker pool of their own that make HTTP requests;
+# see Uploader._run_phase.
+NETWORK_PHASES = ("policy", "transfer", "register", "verify")
+
+# Transports for requests to GitHub (--transport).
+TRANSPORTS = ("urllib3", "http2")
+
+
+# Outcome of one upload in Uploader.upload_many. Exactly one of url and
+# error (an UploadError) is set. size, mime and sha256 (hex digest) are
+# None if the upload failed before they were known; elapsed is in seconds.
+UploadResult = collections.namedtuple(
+    "UploadResult", ["path", "url", "error", "size", "mime", "sha256", "elapsed"]
+)
+
+
+class Uploader:
+    """Uploads files to GitHub as issue attachments.
+
+    An Uploader owns its HTTP client, credentials (persisted in data_dir)
+    and configuration, so several may coexist in a process. upload and
+    upload_many are thread-safe. Credentials are loaded on first upload.
+    With several profiles (see CredentialProfile), each upload goes
+    through the least busy profile that is neither refreshing nor
+    throttled.
+
+    upload uploads a single file and returns its URL; upload_many uploads
+    files concurrently and yields results. Each phase of an upload (policy
+    request, transfer, registration) runs at most jobs at a time, but the
+    phases of different uploads overlap; see _run_phase.
+
+    close shuts down worker pools, background refreshes and connections;
+    an Uploader is also a context manager that closes it on exit.
+    """
+
+    def __init__(
+        self,
+        repository_id=1,
+        proxy=None,
+        jobs=1,
+        use_cache=True,
+        revalidate_cache=False,
+        headless=True,
+        container=False,
+        data_dir=data_dir,
+        github_url=GITHUB_URL,
+        optimize=False,
+        max_dimension=None,
+        strip_metadata=False,
+        cache_dir=cache_dir,
+        max_rate=None,
+        max_bandwidth=None,
+        profiles=None,
+        verify=False,
+        transport="urllib3",
+        compress_text=False,
+    ):
+        if proxy and not re.match(r"^(https?|socks(4a?|5h?))://", proxy):
+            proxy = "http://%s" % proxy
+        if proxy:
+            logger.debug("using proxy %s", proxy)
+        self.github_url = github_url.rstrip("/")
+        self.repository_id = repository_id
+        self.proxy = proxy
+        self.jobs = jobs
+        self.revalidate_cache = revalidate_cache
+        self.verify = verify
+        # Whether to gzip large text files; see GZIP_EXTENSIONS.
+        self.compress_text = compress_text
+        self.headless = headless
+        self.container = container
+        # Each of the NETWORK_PHASES runs up to jobs requests at a time (see
+        # _run_phase), and several may hit the same host (policy requests
+        # and registrations both go to GitHub, say).
+        self.http_client = make_http_client(proxy, maxsize=len(NETWORK_PHASES) * jobs)
+        # Requests to GitHub itself (upload policies, registrations, token
+        # refreshes) go through github_client; requests to storage and
+        # asset downloads through http_client.
+        if transport == "urllib3":
+            self.github_client = self.http_client
+        elif transport == "http2":
+            self.github_client = HTTP2Transport(proxy)
+        else:
+            raise ValueError("unknown transport %s" % transport)
+        # Adapts the number of uploads in flight to throttling and
+        # latency, and caps the upload rate (files/s).
+        self.limiter = AdaptiveLimiter(PIPELINE_DEPTH * jobs, max_rate=max_rate)
+        # Per-phase worker pools, created on first use; see _run_phase.
+        self._phase_executors = {}
+        self._phase_lock = threading.Lock()
+        # Shared by all uploads, so this is a global cap (bytes/s).
+        self.bandwidth_limiter = None
+        if max_bandwidth:
+            self.bandwidth_limiter = TokenBucket(
+                max_bandwidth, max(1 << 16, max_bandwidth / 10)
+            )
+
+        self.data_dir = pathlib.Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True, parents=True)
+        # Uploads are spread across profiles; see _checkout_profile.
+        # "default" names the default profile.
+        self.profiles = []
+        for name in profiles or [None]:
+            name = None if name == "default" else name
+            if any(profile.name == name for profile in self.profiles):
+                continue
+            self.profiles.append(CredentialProfile(self.data_dir, name))
+        self._next_profile = 0
+        self._profiles_cond = threading.Condition()
+        # Set by close; no more refreshes are scheduled.
+        self._closed = False
+        # Name of the last WebDriver launcher that worked, tried first.
+        self.webdriver_file = self.data_dir / "webdriver"
+        # Origin of the last upload_url (the S3 bucket), for prewarm.
+        self.upload_origin_file = self.data_dir / "upload_origin"
+        self._upload_origin = None
+        self._prewarm_lock = threading.Lock()
+        self._prewarmed = False
+        self.cache = UploadCache(self.data_dir / "cache.sqlite3") if use_cache else None
+        self.policy = UploadPolicy(self.data_dir / "policy.json")
+        # Optional image optimization stage; any of the options enables it.
+        self.optimizer = None
+        if optimize or max_dimension or strip_metadata:
+            self.optimizer = ImageOptimizer(
+                pathlib.Path(cache_dir) / "optimized",
+                max_dimension=max_dimension,
+                strip_metadata=strip_metadata,
+                processes=min(jobs, os.cpu_count() or 1),
+            )
+        self.metrics = Metrics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._profiles_cond:
+            self._closed = True
+            for profile in self.profiles:
+                if profile.refresh_timer is not None:
+                    profile.refresh_timer.cancel()
+                    profile.refresh_timer = None
+        with self._phase_lock:
+            executors = list(self._phase_executors.values())
+            self._phase_executors.clear()
+        for executor in executors:
+            executor.shutdown()
+        if self.optimizer:
+            self.optimizer.close()
+        if self.github_client is not self.http_client:
+            self.github_client.clear()
+        self.http_client.clear()
+
+    def prewarm(self):
+        """Opens connections to GitHub and the upload host in the background.
+
+        Up to min(jobs, PREWARM_CONNECTIONS) connections are opened to
+        each host, including TCP, proxy and TLS handshakes, and left in the
+        pools for uploads to pick up, so that the first requests don't pay
+        for the handshakes (which can then overlap with loading credentials
+        and detecting MIME types). The upload host (e.g. the S3 bucket) is
+        remembered from previous uploads. With the http2 transport, a
+        single connection is opened to GitHub, since requests share it.
+        Only the first call does anything.
+        """
+        with self._prewarm_lock:
+            if self._prewarmed:
+                return
+            self._prewarmed = True
+        targets = []
+        origins = []
+        if self.github_client is self.http_client:
+            origins.append(self.github_url)
+        else:
+            targets.append((self.github_client.connect, self.github_url))
+        try:
+            with self.upload_origin_file.open() as fp:
+                self._upload_origin = fp.read().strip() or None
+        except OSError:
+            pass
+        if self._upload_origin and self._upload_origin not in origins:
+            origins.append(self._upload_origin)
+        for origin in origins:
+            for _ in range(min(self.jobs, PREWARM_CONNECTIONS)):
+                targets.append((self._open_connection, origin))
+        for target, url in targets:
+            thread = threading.Thread(target=target, args=(url,))
+            thread.daemon = True
+            thread.start()
+
+    def _open_connection(self, url):
+        try:
+            pool = self.http_client.connection_from_url(url)
+            conn = pool._get_conn()
+        except Exception as e:
+            logger.debug("%s: failed to prewarm connection: %s", url, e)
+            return
+        try:
+            if getattr(pool, "proxy", None) is not None:
+                # Sets up the CONNECT tunnel, then connects.
+                pool._prepare_proxy(conn)
+            else:
+                conn.connect()
+        except Exception as e:
+            logger.debug("%s: failed to prewarm connection: %s", url, e)
+            conn.close()
+            # Return the slot; urllib3 replaces None with a new connection.
+            pool._put_conn(None)
+            return
+        pool._put_conn(conn)
+        self.metrics.count("prewarmed_connections", label=pool_origin(pool))
+
+    def _remember_upload_origin(self, upload_url):
+        parts = urllib.parse.urlsplit(upload_url)
+        origin = "%s://%s" % (parts.scheme, parts.netloc)
+        if origin == self._upload_origin:
+            return
+        self._upload_origin = origin
+        try:
+            write_file_atomically(self.upload_origin_file, origin + "\n")
+        except OSError as e:
+            logger.debug("%s: %s", self.upload_origin_file, e)
+
+    def ensure_credentials(self, profile=None):
+        # Loads the credentials of profile, or of all profiles.
+        for profile in [profile] if profile else self.profiles:
+            with profile.lock:
+                if not profile.loaded:
+                    self.load_cookie_and_token(profile)
+                    profile.loaded = True
+
+    def load_cookie_and_token(self, profile):
+        with profile.lock:
+            with profile.store.lock(shared=True):
+                cookies, token, generation = profile.store.load()
+            if not self._set_credentials(profile, cookies, token, generation):
+                logger.warning(
+                    "%s: persisted cookie and/or token not found or invalid",
+                    profile.label,
+                )
+                self.refresh_cookie_and_token(profile)
+                return
+            logger.debug("%s: persisted cookie and token loaded", profile.label)
+            due = self._refresh_due_at(profile)
+            if due is not None and time.time() >= due:
+                # Better now than in the middle of uploads.
+                logger.info(
+                    "%s: cookie and/or token near expiry; refreshing ahead of time",
+                    profile.label,
+                )
+                self.refresh_cookie_and_token(profile)
+            else:
+                self._schedule_refresh(profile)
+
+    def _set_credentials(self, profile, cookies, token, generation):
+        # Returns False if the credentials are unusable.
+        try:
+            cookie_header = "; ".join(
+                "%s=%s" % (cookie["name"], cookie["value"]) for cookie in cookies
+            )
+        except (TypeError, KeyError):
+            logger.warning(
+                "corruption in cookie jar detected; ignoring persisted cookies"
+            )
+            cookies = []
+            cookie_header = None
+        profile.cookies = cookies
+        profile.cookie_header = cookie_header
+        profile.token = token
+        profile.generation = generation
+        return bool(token and cookie_header)
+
+    def refresh_cookie_and_token(self, profile):
+        # The profile is out of rotation (see _checkout_profile) for the
+        # duration of the refresh.
+        with self._profiles_cond:
+            profile.refreshing = True
+        try:
+            with self.metrics.timer("refresh"):
+                self._refresh_cookie_and_token(profile)
+        finally:
+            with self._profiles_cond:
+                profile.refreshing = False
+                self._profiles_cond.notify_all()
+        self._schedule_refresh(profile)
+
+    def _refresh_due_at(self, profile):
+        # Time (time.time) at which the credentials of profile should be
+        # refreshed ahead of expiry (see REFRESH_AHEAD_FRACTION), or None
+        # if their lifetime is unknown.
+        issued_at = profile.store.issued_at()
+        if issued_at is None:
+            return None
+        lifetimes = []
+        token_lifetime = profile.store.token_lifetime()
+        if token_lifetime is not None:
+            lifetimes.append(token_lifetime)
+        for cookie in profile.cookies:
+            if cookie.get("name") == SESSION_COOKIE and cookie.get("expiry"):
+                lifetimes.append(max(0, cookie["expiry"] - issued_at))
+        if not lifetimes:
+            return None
+        return issued_at + min(lifetimes) * REFRESH_AHEAD_FRACTION
+
+    def _schedule_refresh(self, profile):
+        due = self._refresh_due_at(profile)
+        with self._profiles_cond:
+            if profile.refresh_timer is not None:
+                profile.refresh_timer.cancel()
+                profile.refresh_timer = None
+            if due is None or self._closed:
+                return
+            # Never refresh in a tight loop, even if the session cookie
+            # is about to expire and can't be extended over HTTP.
+            delay = max(FRESH_CREDENTIALS_PERIOD, due - time.time())
+            logger.debug(
+                "%s: refreshing credentials ahead of expiry in %.0fs",
+                profile.label,
+                delay,
+            )
+            timer = threading.Timer(
+                delay, self._refresh_ahead, args=(profile, profile.generation)
+            )
+            timer.daemon = True
+            timer.start()
+            profile.refresh_timer = timer
+
+    def _refresh_ahead(self, profile, generation):
+        # Runs in a timer thread; see _schedule_refresh. Refreshes the
+        # token over HTTP while the current one is still valid. Unlike
+        # refresh_cookie_and_token, this doesn't hold profile.lock or take
+        # the profile out of rotation during the request, so uploads carry
+        # on with the current credentials in the meantime. Never opens a
+        # browser; if the session can't be extended over HTTP, it's left
+        # to a refresh on demand (or at the next start).
+        if profile.generation != generation:
+            return
+        logger.info("%s: refreshing cookie and token ahead of expiry", profile.label)
+        try:
+            with self.metrics.timer("refresh"), profile.store.lock():
+                cookies, token, generation = profile.store.load()
+                if generation > profile.generation and token and cookies:
+                    method = "shared"
+                else:
+                    method = "ahead"
+                    credentials = self._extract_token_over_http(profile)
+                    if credentials is None:
+                        logger.info(
+                            "%s: failed to refresh ahead of expiry", profile.label
+                        )
+                        return
+                    cookies, token = credentials
+                    generation = profile.store.save(cookies, token)
+        except OSError as e:
+            logger.warning(
+                "%s: failed to refresh ahead of expiry: %s", profile.label, e
+            )
+            return
+        with profile.lock:
+            if generation > profile.generation:
+                self._set_credentials(profile, cookies, token, generation)
+                profile.refreshed_at = time.monotonic()
+        self.metrics.count("credential_refreshes", label=method)
+        logger.info("%s: cookie and token refreshed ahead of expiry", profile.label)
+        self._schedule_refresh(profile)
+
+    def _refresh_cookie_and_token(self, profile):
+        with profile.lock, profile.store.lock():
+            cookies, token, generation = profile.store.load()
+            if generation > profile.generation and self._set_credentials(
+                profile, cookies, token, generation
+            ):
+                logger.info(
+                    "%s: picked up cookie and token refreshed by another process",
+                    profile.label,
+                )
+                self.metrics.count("credential_refreshes", label="shared")
+                profile.refreshed_at = time.monotonic()
+                return
+            credentials = None
+            method = "http"
+            if profile.cookie_header:
+                credentials = self._extract_token_over_http(profile)
+            if credentials is None:
+                method = "browser"
+                credentials = self._extract_cookie_and_token(profile)
+            self.metrics.count("credential_refreshes", label=method)
+            cookies, token = credentials
+            profile.generation = profile.store.save(cookies, token)
+            self._set_credentials(profile, cookies, token, profile.generation)
+            logger.info("%s: cookie and token refreshed", profile.label)
+            profile.refreshed_at = time.monotonic()
+
+    def _extract_token_over_http(self, profile):
+        # Fast path for when session cookies are still valid: loads the
+        # issue page with the HTTP client, and returns (cookies, token), or
+        # None if that's not enough to get a token (e.g. the session has
+        # expired and we're presented with the login form).
+        logger.info("refreshing token over HTTP...")
+        start = time.monotonic()
+        cookies = [dict(cookie) for cookie in profile.cookies]
+        url = self.github_url + ISSUE_PATH
+        origin = urllib.parse.urlsplit(self.github_url)[:2]
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                cookie_header = "; ".join(
+                    "%s=%s" % (cookie["name"], cookie["value"]) for cookie in cookies
+                )
+                r = self.github_client.request(
+                    "GET", url, headers={"Cookie": cookie_header}, redirect=False
+                )
+                merge_set_cookie_headers(
+                    cookies, r.headers, urllib.parse.urlsplit(url).hostname
+                )
+                if r.status not in (301, 302, 303, 307, 308):
+                    break
+                url = urllib.parse.urljoin(url, r.headers["Location"])
+                logger.debug("redirected to %s", url)
+                # The session cookie must not leave GitHub.
+                if urllib.parse.urlsplit(url)[:2] != origin:
+                    logger.debug("refusing to follow off-origin redirect")
+                    return None
+            else:
+                logger.debug("too many redirects")
+                return None
+        except (HTTPError, KeyError) as e:
+            logger.debug("failed to load issue page: %s", e)
+            return None
+        if r.status != 200:
+            logger.debug("%s: HTTP %d", url, r.status)
+            return None
+        parser = IssuePageParser()
+        parser.feed(r.data.decode("utf-8", errors="replace"))
+        if not parser.user_login:
+            logger.info("session expired; falling back to browser login")
+            return None
+        if not parser.token:
+            logger.debug("%s: authenticity token not found", url)
+            return None
+        logger.info("extracted authenticity token: %s", parser.token)
+        logger.debug("token refreshed over HTTP in %.2fs", time.monotonic() - start)
+        return cookies, parser.token
+
+    def _launch_driver(self):
+        from selenium.common.exceptions import WebDriverException
+
+        try:
+            with self.webdriver_file.open() as fp:
+                preferred = fp.read().strip()
+        except OSError:
+            preferred = None
+        names = list(WEBDRIVER_LAUNCHERS)
+        if preferred in names:
+            names.remove(preferred)
+            names.insert(0, preferred)
+        for name in names:
+            start = time.monotonic()
+            try:
+                driver = WEBDRIVER_LAUNCHERS[name](
+                    headless=self.headless, container=self.container
+                )
+            except WebDriverException as e:
+                logger.debug(e)
+                continue
+            logger.debug("%s launched in %.2fs", name, time.monotonic() - start)
+            if name != preferred:
+                try:
+                    with self.webdriver_file.open("w") as fp:
+                        print(name, file=fp)
+                except OSError as e:
+                    logger.debug("failed to remember webdriver preference: %s", e)
+            return driver
+        raise RuntimeError(
+            "cannot load suitable webdriver; "
+            "please install Chrome/Chromium and chromedriver, or Firefox and geckodriver"
+        )
+
+    def _extract_cookie_and_token(self, profile):
+        # Logs in through a browser session, and returns (cookies, token).
+        from selenium.common.exceptions import (
+            WebDriverException,
+            NoSuchElementException,
+            JavascriptException,
+        )
+
+        start = time.monotonic()
+        driver = self._launch_driver()
+
+        logger.info("refreshing cookie and token...")
+        try:
+            if profile.cookies:
+                logger.info("preparing browser session with persisted cookies...")
+                # Web driver requires navigating to the domain before adding cookies.
+                driver.get(self.github_url + "/404")
+                try:
+                    for cookie in profile.cookies:
+                        driver.add_cookie(cookie)
+                except WebDriverException:
+                    logger.warning(
+                        "corruption in cookie jar detected; ignoring some persisted cookies"
+                    )
+            logger.info("logging in...")
+            driver.get(self.github_url + ISSUE_PATH)
+            # Each of the login, TOTP and account recovery pages is handled
+            # at most once, in whatever order they show up, until we land
+            # on the issue page.
+            selectors = [LOGIN_SELECTOR, OTP_SELECTOR, POSTPONE_SELECTOR, CSRF_SELECTOR]
+            while True:
+                selector, element = wait_for_any_element(
+                    driver, selectors, PAGE_LOAD_TIMEOUT
+                )
+                logger.debug(
+                    "%.2fs: found %s", time.monotonic() - start, selector or "nothing"
+                )
+                if selector is None or selector == CSRF_SELECTOR:
+                    break
+                selectors.remove(selector)
+                try:
+                    if selector == LOGIN_SELECTOR:
+                        submit_button = self._fill_in_login_form(
+                            driver, element, profile
+                        )
+                    elif selector == OTP_SELECTOR:
+                        submit_button = self._fill_in_totp_form(
+                            driver, element, profile
+                        )
+                    else:
+                        submit_button = element
+                    submit_button.click()
+                except NoSuchElementException:
+                    continue
+                wait_for_navigation(driver, submit_button, PAGE_LOAD_TIMEOUT)
+            logger.info("issue page loaded")
+
+            token = None
+            try:
+                token = driver.execute_script(
+                    "return document.querySelector('input[data-csrf=true]').value;"
+                )
+            except JavascriptException as e:
+                write_page_source_and_report_error(
+                    driver.page_source, "JavaScript exception: %s" % e
+                )
+            if not token:
+                write_page_source_and_report_error(
+                    driver.page_source,
+                    "failed to extract uploadPolicyAuthenticityToken",
+                )
+            logger.info("extracted authenticity token: %s", token)
+
+            cookies = driver.get_cookies()
+            logger.debug(
+                "extracted cookie: %s",
+                "; ".join("%s=%s" % (c["name"], c["value"]) for c in cookies),
+            )
+            logger.debug("browser login took %.2fs", time.monotonic() - start)
+            return cookies, token
+        finally:
+            driver.quit()
+
+    def _fill_in_login_form(self, driver, username_field, profile):
+        # Returns the submit button.
+        from selenium.webdriver.common.by import By
+
+        password_field = driver.find_element(By.CSS_SELECTOR, "input[name=password]")
+        submit_button = driver.find_element(By.CSS_SELECTOR, "input[type=submit]")
+        username_var = profile.env_var("GITHUB_USERNAME")
+        username = os.getenv(username_var)
+        if username:
+            logger.info("using username '%s' from %s", username, username_var)
+        else:
+            username = input("GitHub username (%s): " % profile.label)
+        password_var = profile.env_var("GITHUB_PASSWORD")
+        password = os.getenv(password_var)
+        if password:
+            logger.info("using password from %s", password_var)
+        else:
+            password = getpass.getpass("Password (never stored): ")
+        username_field.send_keys(username)
+        password_field.send_keys(password)
+        return submit_button
+
+    def _fill_in_totp_form(self, driver, totp_field, profile):
+        # Returns the submit button.
+        from selenium.webdriver.common.by import By
+
+        submit_button = driver.find_element(By.CSS_SELECTOR, "button[type=submit]")
+        totp_secret_var = profile.env_var("GITHUB_TOTP_SECRET")
+        totp_secret = os.getenv(totp_secret_var)
+        if totp_secret:
+            import pyotp
+
+            totp = pyotp.TOTP(totp_secret).now()
+            logger.info("using TOTP %s derived from %s", totp, totp_secret_var)
+        else:
+            totp = input("TOTP (%s): " % profile.label)
+        totp_field.send_keys(totp)
+        return submit_button
+
+    def refresh_stale_credentials(self, stale_token, profile=None):
+        # Returns True if the caller should retry with the current
+        # credentials, or False if the credentials were already fresh (in
+        # which case the staleness hypothesis is wrong). profile defaults
+        # to the first profile.
+        profile = profile or self.profiles[0]
+        with profile.lock:
+            if profile.token != stale_token:
+                logger.debug("credentials already refreshed by another upload")
+                return True
+            if (
+                profile.refreshed_at is not None
+                and time.monotonic() - profile.refreshed_at < FRESH_CREDENTIALS_PERIOD
+            ):
+                return False
+            logger.warning("%s: cookie and/or token appear stale", profile.label)
+            # Learn how long tokens last; see _refresh_due_at.
+            issued_at = profile.store.issued_at()
+            if issued_at is not None:
+                lifetime = time.time() - issued_at
+                logger.debug("%s: token expired after %.0fs", profile.label, lifetime)
+                if lifetime >= MIN_TOKEN_LIFETIME:
+                    try:
+                        profile.store.record_token_lifetime(lifetime)
+                    except OSError as e:
+                        logger.debug("%s: %s", profile.store.lifetimes_file, e)
+            self.refresh_cookie_and_token(profile)
+            return True
+
+    @contextlib.contextmanager
+    def _checkout_profile(self):
+        # Yields the profile to upload with: the one with the fewest
+        # uploads in flight among those not refreshing or throttled, ties
+        # going round-robin. Waits if there is no such profile.
+        with self._profiles_cond:
+            while True:
+                now = time.monotonic()
+                available = [i for i, p in enumerate(self.profiles) if p.available(now)]
+                if available:
+                    break
+                resume_at = [
+                    p.throttled_until for p in self.profiles if not p.refreshing
+                ]
+                self._profiles_cond.wait(min(resume_at) - now if resume_at else None)
+            n = len(self.profiles)
+            index = min(
+                available,
+                key=lambda i: (
+                    self.profiles[i].in_flight,
+                    (i - self._next_profile) % n,
+                ),
+            )
+            self._next_profile = (index + 1) % n
+            profile = self.profiles[index]
+            profile.in_flight += 1
+        try:
+            yield profile
+        finally:
+            with self._profiles_cond:
+                profile.in_flight -= 1
+                self._profiles_cond.notify_all()
+
+    def _throttle_profile(self, profile, delay):
+        with self._profiles_cond:
+            profile.throttled_until = max(
+                profile.throttled_until, time.monotonic() + delay
+            )
+            self._profiles_cond.notify_all()
+
+    def _lookup_cached_asset(self, path, key):
+        asset_url = self.cache.lookup(key)
+        if not asset_url:
+            return None
+        if self.revalidate_cache:
+            logger.debug("%s: revalidating cached URL %s ...", path, asset_url)
+            try:
+                r = self.http_client.request("HEAD", asset_url)
+                valid = r.status == 200
+            except HTTPError as e:
+                logger.debug("%s: %s", asset_url, e)
+                valid = False
+            if not valid:
+                logger.debug("%s: cached URL %s is gone", path, asset_url)
+                self.cache.invalidate(key)
+                return None
+        logger.debug("%s: cache hit: %s", path, asset_url)
+        return asset_url
+
+    def upload(self, path, info=None, fileobj=None):
+        # Returns the URL of the uploaded file. If info is a dict, size,
+        # mime and sha256 are recorded in it as they become known. If
+        # fileobj (a seekable binary file) is given, its content is
+        # uploaded as path.name instead, and path need not exist.
+        if info is None:
+            info = {}
+        self.prewarm()
+        start = time.monotonic()
+        try:
+            with self.metrics.timer("upload"):
+                asset_url = self._upload(path, info, fileobj)
+        except Exception:
+            self.metrics.count("uploads", label="failure")
+            raise
+        logger.debug("%s: finished in %.3fs", path, time.monotonic() - start)
+        return asset_url
+
+    def upload_bundle(self, paths, name, info=None):
+        """Uploads files as a single ZIP archive, and returns its URL.
+
+        The archive is uploaded as name (which should end in .zip), and
+        files are stored under the paths given (relative to the root for
+        absolute paths). paths may be any iterable; the archive is written
+        in a background thread (to memory, or to a temporary file beyond
+        SPOOL_THRESHOLD) while connections are prewarmed and credentials
+        loaded. Raises UploadError if any of the files can't be read.
+        """
+        self.prewarm()
+        path = pathlib.Path(name)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD) as spool:
+
+            def build():
+                with self.metrics.timer("compress"):
+                    return write_bundle(paths, spool)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(build)
+                self.ensure_credentials()
+                count = future.result()
+            if not count:
+                raise UploadError("%s: no files to bundle" % name)
+            logger.debug("%s: bundled %d files", name, count)
+            return self.upload(path, info, fileobj=spool)
+
+    def _upload(self, path, info, fileobj=None, name=None):
+        # Uploads fileobj, if given, or else path, as name (defaults to
+        # path.name).
+        name = name or path.name
+        if fileobj is None:
+            if not path.is_file():
+                raise UploadError("%s: does not exist" % path)
+            size = info["size"] = path.stat().st_size
+            if (
+                self.compress_text
+                and path.suffix.lower() in GZIP_EXTENSIONS
+                and size >= GZIP_MIN_SIZE
+            ):
+                with self.metrics.timer("compress"):
+                    compressed = gzip_file(path)
+                logger.debug("%s: compressed for upload as %s.gz", path, name)
+                with compressed:
+                    return self._upload(path, info, compressed, name + ".gz")
+            with self.metrics.timer("mime"):
+                content_type = info["mime"] = detect_mime_type(path)
+        else:
+            fileobj.seek(0, io.SEEK_END)
+            size = info["size"] = fileobj.tell()
+            content_type = info["mime"] = guess_mime_type(name)
+        if not content_type:
+            raise UploadError("%s: cannot detect or guess MIME type" % path)
+
+        # The content actually uploaded (a path or a file object), under
+        # name.
+        upload_path = fileobj or path
+        digest = None
+        if (
+            self.optimizer
+            and fileobj is None
+            and content_type in self.optimizer.CONTENT_TYPES
+        ):
+            with self.metrics.timer("hash"):
+                digest = sha256_file(path)
+            with self.metrics.timer("optimize"):
+                upload_path = self.optimizer.optimize(path, content_type, digest)
+            if upload_path != path:
+                size = info["size"] = upload_path.stat().st_size
+                digest = None
+        self.policy.check(path, content_type, size)
+
+        cache_key = None
+        if self.cache:
+            if digest is None:
+                with self.metrics.timer("hash"):
+                    digest = sha256_file(upload_path)
+            info["sha256"] = digest
+            cache_key = (digest, size, content_type, self.repository_id)
+            with self.metrics.timer("cache"):
+                asset_url = self._lookup_cached_asset(path, cache_key)
+            if asset_url:
+                self.metrics.count("uploads", label="cached")
+                return asset_url
+
+        attempt = 0
+        while True:
+            with self.limiter, self._checkout_profile() as profile:
+                try:
+                    self.ensure_credentials(profile)
+                    asset_url = self._upload_to_github(
+                        path, name, upload_path, size, content_type, info, profile
+                    )
+                    break
+                except Throttled as e:
+                    attempt += 1
+                    if e.phase != "transfer" and len(self.profiles) > 1:
+                        # GitHub throttles accounts, not clients: take this
+                        # profile out of rotation and carry on with others.
+                        delay = backoff_delay(e.retry_after, attempt)
+                        self._throttle_profile(profile, delay)
+                        retry = "retrying with another profile"
+                    else:
+                        delay = self.limiter.throttled(e.retry_after, attempt)
+                        retry = "retrying in %.1fs" % delay
+                    if attempt > MAX_THROTTLED_RETRIES:
+                        raise
+                    logger.warning("%s; %s", e, retry)
+
+        if self.verify:
+            # info["sha256"] is the digest of the content as it was
+            # streamed to storage, so the file isn't read again.
+            self._run_phase("verify", self._verify, path, asset_url, info["sha256"])
+
+        logger.debug("%s: upload success (profile %s)", path, profile.label)
+        self.metrics.count("uploads", label="success")
+        self.metrics.count("profile_uploads", label=profile.label)
+        self.metrics.count("profile_bytes", size, label=profile.label)
+        if cache_key:
+            with self.metrics.timer("cache"):
+                self.cache.store(cache_key, asset_url)
+        return asset_url
+
+    def _check_throttling(self, path, phase, r, data):
+        # Raises Throttled on 429, 503 with Retry-After (or S3's SlowDown)
+        # and 403 responses that look like GitHub's abuse/secondary rate
+        # limits. Other 503s are plain server errors; see
+        # _check_server_error.
+        throttled = (
+            r.status == 429
+            or (
+                r.status == 503
+                and ("Retry-After" in r.headers or "<Code>SlowDown</Code>" in data)
+            )
+            or (
+                r.status == 403
+                and (
+                    "Retry-After" in r.headers
+                    or re.search(r"abuse|rate limit", data, re.I) is not None
+                )
+            )
+        )
+        if not throttled:
+            return
+        self.metrics.count("throttled", label=phase)
+        raise Throttled(
+            "%s: throttled during %s (HTTP %d)" % (path, phase, r.status),
+            parse_retry_after(r.headers.get("Retry-After")),
+            phase,
+        )
+
+    def _upload_to_github(
+        self, path, name, upload_path, size, content_type, info, profile
+    ):
+        # Uploads the content of upload_path as name with the credentials
+        # of profile, and returns the asset URL. Each phase runs in its own
+        # worker pool; see _run_phase.
+        #
+        # A phase failing with a TransientError (or a network error) is
+        # retried after a jittered backoff (see MAX_PHASE_RETRIES), picking
+        # up where the upload left off: a failed registration is retried
+        # without transferring the file again, and a failed transfer with
+        # the same policy, unless it is about to expire. Throttled
+        # transfers and registrations resume the same way, after the delay
+        # requested by the server; throttled policy requests are left to
+        # _upload, which may switch profiles.
+        policy = cookie_header = None
+        transferred = False
+        retries = 0
+        throttled = 0
+        while True:
+            phase = "policy"
+            try:
+                if policy is not None and not transferred:
+                    expiry = policy_expiry(policy)
+                    if (
+                        expiry is not None
+                        and expiry - time.time() < POLICY_EXPIRY_MARGIN
+                    ):
+                        logger.debug("%s: upload policy expiring; renewing", path)
+                        policy = None
+                if policy is None:
+                    policy, cookie_header = self._run_phase(
+                        "policy",
+                        self._request_policy,
+                        path,
+                        name,
+                        size,
+                        content_type,
+                        profile,
+                    )
+                if not transferred:
+                    phase = "transfer"
+                    self._run_phase(
+                        "transfer",
+                        self._transfer,
+                        path,
+                        name,
+                        upload_path,
+                        policy,
+                        info,
+                    )
+                    transferred = True
+                    self.metrics.count("uploaded_bytes", size)
+                phase = "register"
+                self._run_phase("register", self._register, path, policy, cookie_header)
+                if retries:
+                    logger.debug("%s: uploaded after %d retries", path, retries)
+                return policy["asset"]["href"]
+            except Throttled as e:
+                throttled += 1
+                if e.phase == "policy" or throttled > MAX_THROTTLED_RETRIES:
+                    raise
+                delay = self.limiter.throttled(e.retry_after, throttled)
+                logger.warning("%s; resuming %s in %.1fs", e, phase, delay)
+                time.sleep(delay)
+            except (TransientError, HTTPError) as e:
+                retries += 1
+                if retries > MAX_PHASE_RETRIES:
+                    if isinstance(e, UploadError):
+                        raise
+                    raise UploadError("%s: %s" % (path, e))
+                self.metrics.count("phase_retries", label=phase)
+                delay = random.uniform(
+                    0,
+                    min(
+                        PHASE_RETRY_MAX_DELAY,
+                        PHASE_RETRY_BASE_DELAY * 2 ** (retries - 1),
+                    ),
+                )
+                logger.debug(
+                    "%s: %s failed (%s); retrying in %.2fs (retry %d)",
+                    path,
+                    phase,
+                    e,
+                    delay,
+                    retries,
+                )
+                time.sleep(delay)
+            except (OSError, AssertionError) as e:
+                raise UploadError("%s: %s" % (path, e))
+
+    def _check_server_error(self, path, what, r):
+        # Raises TransientError on 5xx responses; call after
+        # _check_throttling.
+        if r.status >= 500:
+            raise TransientError("%s: %s: HTTP %d" % (path, what, r.status))
+
+    def _run_phase(self, phase, fn, *args):
+        # Runs fn in the worker pool of phase, and waits for the result.
+        # Policy requests, transfers and registrations run in separate
+        # pools of jobs workers each, and with more uploads than that in
+        # flight (see PIPELINE_DEPTH), they overlap: policies for upcoming
+        # files are fetched while earlier files are being transferred, and
+        # registrations don't queue up behind transfers. Each pool's queue
+        # is bounded by the number of uploads in flight.
+        with self._phase_lock:
+            executor = self._phase_executors.get(phase)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+                self._phase_executors[phase] = executor
+        return executor.submit(fn, *args).result()
+
+    def _request_policy(self, path, name, size, content_type, profile):
+        # Returns the upload policy (parsed JSON) and the cookie header it
+        # was requested with.
+        while True:
+            logger.debug("%s: retrieving asset upload credentials...", path)
+            # Snapshot credentials, since they may be swapped out by a
+            # refresh in another thread while this request is in flight.
+            with profile.lock:
+                current_token = profile.token
+                current_cookie_header = profile.cookie_header
+            with self.metrics.timer("policy") as elapsed:
+                r = self.github_client.request(
+                    "POST",
+                    self.github_url + "/upload/policies/assets",
+                    headers={
+                        "Accept": "application/json",
+                        "Cookie": current_cookie_header,
+                    },
+                    fields={
+                        "name": name,
+                        "size": size,
+                        "content_type": content_type,
+                        "authenticity_token": current_token,
+                        "repository_id": self.repository_id,
+                    },
+                )
+                data = r.data.decode("utf-8")
+            logger.debug("/upload/policies/assets: HTTP %d: %s", r.status, data)
+            self.limiter.observe(elapsed[0])
+            self._check_throttling(path, "policy", r, data)
+            self._check_server_error(path, "/upload/policies/assets", r)
+            if r.status == 422:
+                if r.headers["Content-Type"].startswith("text/html"):
+                    if self.refresh_stale_credentials(current_token, profile):
+                        self.metrics.count("retries")
+                        continue
+                    raise UploadError(
+                        "%s: unexpected 422 text/html response from /upload/policies/assets"
+                        % path
+                    )
+                if (
+                    r.headers["Content-Type"].startswith("application/json")
+                    and "content_type" in data
+                ):
+                    self.policy.reject(content_type)
+                    raise UploadError(
+                        "%s: unsupported MIME type %s" % (path, content_type)
+                    )
+                raise UploadError(
+                    "%s: 422 response from /upload/policies/assets: %s" % (path, data)
+                )
+            assert r.status == 201, (
+                "/upload/policies/assets: expected HTTP 201, got %d" % r.status
+            )
+            policy = json.loads(data, object_pairs_hook=collections.OrderedDict)
+            return policy, current_cookie_header
 
-try:
-    import magic
-except ImportError:
-    magic = None
+    def _transfer(self, path, name, upload_path, policy, info):
+        logger.debug("%s: uploading...", path)
+        upload_url = policy["upload_url"]
+        self._remember_upload_origin(upload_url)
+        with self.metrics.timer("transfer"), MultipartFileBody(
+            policy["form"],
+            "file",
+            name,
+            upload_path,
+            throttle=self.bandwidth_limiter,
+        ) as body:
+            try:
+                r = self.http_client.request(
+                    "POST",
+                    upload_url,
+                    body=body,
+                    headers={
+                        "Content-Type": body.content_type,
+                        "Content-Length": str(body.content_length),
+                    },
+                    timeout=Timeout(connect=3.0),
+                )
+            except HTTPError:
+                self._count_wasted_bytes(path, body.tell())
+                raise
+            info["sha256"] = body.sha256 or info.get("sha256")
+            sent = body.tell()
+        data = r.data.decode("utf-8")
+        logger.debug("%s: HTTP %d: %s", upload_url, r.status, data)
+        if r.status != 204:
+            self._count_wasted_bytes(path, sent)
+        self._check_throttling(path, "transfer", r, data)
+        self._check_server_error(path, upload_url, r)
+        assert r.status == 204, "%s: expected HTTP 204, got %d" % (
+            upload_url,
+            r.status,
+        )
 
-try:
-    from urllib3.contrib.socks import SOCKSProxyManager
-except ImportError:
-    SOCKSProxyManager = None
+    def _count_wasted_bytes(self, path, n):
+        # Bytes sent in a failed transfer.
+        logger.debug("%s: %d bytes sent in vain", path, n)
+        self.metrics.count("wasted_bytes", n)
 
+    def _register(self, path, policy, cookie_header):
+        logger.debug("%s: registering asset...", path)
+        register_url = policy["asset_upload_url"]
+        with self.metrics.timer("register") as elapsed:
+            r = self.github_client.request(
+                "PUT",
+                urllib.parse.urljoin(self.github_url, register_url),
+                headers={"Accept": "application/json", "Cookie": cookie_header},
+                fields={
+                    "authenticity_token": policy["asset_upload_authenticity_token"]
+                },
+            )
+        data = r.data.decode("utf-8")
+        logger.debug("%s: HTTP %d: %s", register_url, r.status, data)
+        self.limiter.observe(elapsed[0])
+        self._check_throttling(path, "register", r, data)
+        self._check_server_error(path, register_url, r)
+        assert r.status == 200, "%s: expected HTTP 200, got %d" % (
+            register_url,
+            r.status,
+        )
 
-ISSUE_URL = "https://www.github.com/login?return_to=%2Fmojombo%2Fgrit%2Fissues%2F1"
+    def _verify(self, path, asset_url, digest):
+        # Downloads asset_url and checks that its SHA-256 digest is digest.
+        # Freshly registered assets may not be served right away, so 404s
+        # and connection errors are retried with exponential backoff, for
+        # up to VERIFY_TIMEOUT.
+        logger.debug("%s: verifying %s ...", path, asset_url)
+        deadline = time.monotonic() + VERIFY_TIMEOUT
+        delay = VERIFY_INITIAL_DELAY
+        with self.metrics.timer("verify"):
+            while True:
+                try:
+                    r = self.http_client.request(
+                        "GET", asset_url, preload_content=False
+                    )
+                    try:
+                        if r.status == 200:
+                            h = hashlib.sha256()
+                            for chunk in r.stream(1 << 16):
+                                h.update(chunk)
+                            break
+                        r.read()
+                    finally:
+                        r.release_conn()
+                    error = "HTTP %d" % r.status
+                    if r.status != 404:
+                        delay = None
+                except HTTPError as e:
+                    error = str(e)
+                if delay is None or time.monotonic() + delay > deadline:
+                    self.metrics.count("verifications", label="failure")
+                    raise UploadError(
+                        "%s: verification failed: %s: %s" % (path, asset_url, error)
+                    )
+                logger.debug(
+                    "%s: %s: %s; retrying in %.2fs", path, asset_url, error, delay
+                )
+                time.sleep(delay)
+                delay *= 2
+        if h.hexdigest() != digest:
+            self.metrics.count("verifications", label="mismatch")
+            raise UploadError(
+                "%s: verification failed: %s has SHA-256 %s, expected %s"
+                % (path, asset_url, h.hexdigest(), digest)
+            )
+        self.metrics.count("verifications", label="ok")
+        logger.debug("%s: verified %s", path, asset_url)
 
-logging.config.dictConfig(
-    {
-        "version": 1,
-        "formatters": {
-            "brief": {
-                "format": "%(asctime)s [%(levelname)s] %(message)s",
-                "datefmt": "%H:%M:%S",
-            }
-        },
-        "handlers": {
-            "console": {
-                "class": "logging.StreamHandler",
-                "formatter": "brief",
-                "level": "INFO",
-            }
-        },
-        "loggers": {"ghuc": {"level": "INFO", "handlers": ["console"]}},
-    }
-)
-logger = logging.getLogger("ghuc")
+    def upload_many(self, paths, ordered=False, journal=None):
+        """Uploads files concurrently, yielding an UploadResult for each.
 
-# Global configs
-repository_id = 1
-proxy = None
-headless = True
-container = False
+        Results are yielded as uploads complete, or in the order of paths
+        if ordered is True. paths may be any iterable, and is consumed
+        lazily, in a background thread, so that a slow producer (e.g. a
+        pipe) doesn't hold back results of finished uploads. Errors other
+        than UploadError (e.g. failure to extract credentials) abort the
+        remaining uploads and are propagated.
 
-data_dir = appdirs.user_data_dir("ghuc", "org.zhimingwang", roaming=True, as_path=True)
-data_dir.mkdir(exist_ok=True, parents=True)
-cookie_file = data_dir / "cookies"
-token_file = data_dir / "token"
-
-# credentials_fresh is initialized as False, and set to True once
-# refresh_cookie_and_token is run. Used to make sure we don't blame
-# /upload/policies/assets failure on stale credentials twice in a single
-# session.
-credentials_fresh = False
-cookies = []
-cookie_header = None
-token = None
+        If journal (an UploadJournal) is given, files it records as uploaded
+        are not uploaded again, and other uploads are recorded in it.
+        """
+        self.prewarm()
+        # Up to workers uploads are in flight, so that their phases overlap
+        # (see _run_phase), and at most max_pending paths are pulled from
+        # paths ahead of finished uploads.
+        workers = PIPELINE_DEPTH * self.jobs
+        max_pending = 2 * workers
+        slots = threading.Semaphore(max_pending)
+        stopped = threading.Event()
+        # Receives (index, future) for each finished upload, and finally
+        # (count, None), or (None, exception) if iterating paths failed.
+        done = queue.Queue()
+        pending = {}
+        pending_lock = threading.Lock()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
 
-__version__ = "0.1"
+        def run(path):
+            try:
+                if journal is None:
+                    return self._upload_result(path)
+                entry = journal.lookup(path)
+                if entry is not None:
+                    logger.debug("%s: uploaded in a previous run", path)
+                    self.metrics.count("uploads", label="journaled")
+                    return UploadResult(
+                        path,
+                        entry["url"],
+                        None,
+                        entry["size"],
+                        entry.get("mime"),
+                        entry.get("sha256"),
+                        0.0,
+                    )
+                st = journal.start(path)
+                result = self._upload_result(path)
+                if not result.error:
+                    journal.finish(path, result, st)
+                return result
+            finally:
+                slots.release()
 
+        def feed():
+            count = 0
+            try:
+                for path in paths:
+                    slots.acquire()
+                    if stopped.is_set():
+                        return
+                    with pending_lock:
+                        future = executor.submit(run, path)
+                        pending[count] = future
+                    future.add_done_callback(
+                        lambda future, index=count: done.put((index, future))
+                    )
+                    count += 1
+            except BaseException as e:
+                done.put((None, e))
+                return
+            done.put((count, None))
 
-class ExtractionError(Exception):
-    pass
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            total = None
+            received = 0
+            finished = {}
+            next_yield_index = 0
+            while total is None or received < total:
+                index, future = done.get()
+                if future is None:
+                    total = index
+                    continue
+                if index is None:
+                    raise future
+                received += 1
+                with pending_lock:
+                    del pending[index]
+                result = future.result()
+                if not ordered:
+                    yield result
+                    continue
+                finished[index] = result
+                while next_yield_index in finished:
+                    yield finished.pop(next_yield_index)
+                    next_yield_index += 1
+        except BaseException:
+            # Don't start any more uploads after a fatal error (or when
+            # the generator is closed early).
+            stopped.set()
+            slots.release()
+            with pending_lock:
+                for future in pending.values():
+                    future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
 
+    def _upload_result(self, path, upload=None):
+        # upload(path, info) defaults to self.upload.
+        upload = upload or self.upload
+        info = {}
+        start = time.monotonic()
+        try:
+            url, error = upload(path, info), None
+        except UploadError as e:
+            url, error = None, e
+        return UploadResult(
+            path,
+            url,
+            error,
+            info.get("size"),
+            info.get("mime"),
+            info.get("sha256"),
+            time.monotonic() - start,
+        )
 
-class UploadError(Exception):
-    pass
 
+class UploadDaemon:
+    """Upload server listening on a Unix domain socket.
 
-def load_cookie_and_token():
-    global cookies
-    global cookie_header
-    global token
+    The Uploader, with its credentials and warm connection pools, is kept
+    in memory for the lifetime of the server, and uploads from all clients
+    share a single worker pool of PIPELINE_DEPTH * uploader.jobs threads.
 
-    try:
-        logger.debug("loading token from %s ...", token_file)
-        with token_file.open() as fp:
-            token = fp.read().strip()
-    except OSError:
-        token = None
+    The protocol is newline-delimited JSON: the client sends one
+    {"id": ..., "path": ...} object per file, then shuts down its end of
+    the connection for writing; the server replies with one
+    {"id": ..., "url": ...} or {"id": ..., "error": ...} object per file,
+    in order of completion.
 
-    try:
-        logger.debug("loading cookies from %s ...", cookie_file)
-        cookies = []
-        with cookie_file.open() as fp:
-            cookies = json.load(fp)
-    except (OSError, json.JSONDecodeError):
-        pass
-    try:
-        cookie_header = "; ".join(
-            "%s=%s" % (cookie["name"], cookie["value"]) for cookie in cookies
+    Wraps a socketserver server, imported only when needed.
+    """
+
+    def __init__(self, address, uploader, metrics_file=None):
+        import socketserver
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(handler):
+                DaemonRequestHandler(self, handler.rfile, handler.wfile).handle()
+
+        self._server = Server(address, Handler)
+        self.uploader = uploader
+        self.metrics_file = metrics_file
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=PIPELINE_DEPTH * uploader.jobs
         )
-    except (TypeError, KeyError):
-        logger.warning("corruption in cookie jar detected; ignoring persisted cookies")
-        cookies = []
-        cookie_header = None
 
-    if not token or not cookie_header:
-        logger.warning("persisted cookie and/or token not found or invalid")
-        refresh_cookie_and_token()
-    else:
-        logger.debug("persisted cookie and token loaded")
+    def serve_forever(self):
+        self._server.serve_forever()
 
+    def shutdown(self):
+        self._server.shutdown()
 
-def launch_firefox_driver():
-    logger.debug("loading geckodriver...")
-    options = FirefoxOptions()
-    options.headless = headless
-    return Firefox(options=options)
+    def write_metrics(self):
+        if self.metrics_file:
+            write_metrics_file(self.uploader, self.metrics_file)
 
+    def server_close(self):
+        self._server.server_close()
+        self.executor.shutdown(wait=False)
 
-def launch_chrome_driver():
-    logger.debug("loading chromedriver...")
-    options = ChromeOptions()
-    options.headless = headless
-    if container:
-        options.add_argument("--no-sandbox")
-    return Chrome(options=options)
 
+class DaemonRequestHandler:
+    # Serves one client connection of an UploadDaemon.
 
-def write_page_source_and_report_error(source, msg):
-    fd, temp_path = tempfile.mkstemp(suffix=".html", prefix="ghuc-")
-    with os.fdopen(fd, "w") as fp:
-        fp.write(source)
-    logger.error("%s (page source written to %s)", msg, temp_path)
-    raise ExtractionError
+    def __init__(self, server, rfile, wfile):
+        self.server = server
+        self.rfile = rfile
+        self.wfile = wfile
 
+    def handle(self):
+        self.write_lock = threading.Lock()
+        futures = []
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                request_id = request["id"]
+                path = pathlib.Path(request["path"])
+            except (ValueError, KeyError, TypeError):
+                self.reply({"error": "malformed request: %r" % line})
+                continue
+            logger.info("%s: upload requested", path)
+            futures.append(self.server.executor.submit(self.upload, request_id, path))
+        concurrent.futures.wait(futures)
+        self.server.write_metrics()
 
-def secure_file_permissions(path):
-    if path.stat().st_mode & 0o7777 != 0o0600:
+    def upload(self, request_id, path):
         try:
-            path.chmod(0o0600)
-        except OSError:
-            logger.warning("%s: failed to chmod to 0600", path)
+            response = {"id": request_id, "url": self.server.uploader.upload(path)}
+        except UploadError as e:
+            logger.error("%s", e)
+            response = {"id": request_id, "error": str(e)}
+        except ExtractionError:
+            response = {"id": request_id, "error": "failed to extract credentials"}
+        except Exception as e:
+            logger.exception("unexpected error")
+            response = {"id": request_id, "error": "unexpected error: %s" % e}
+        self.reply(response)
 
+    def reply(self, response):
+        with self.write_lock:
+            try:
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            except OSError:
+                # Client went away.
+                pass
 
-def refresh_cookie_and_token():
-    global credentials_fresh
-    global cookies
-    global cookie_header
-    global token
 
-    driver = None
-    for launcher in (launch_firefox_driver, launch_chrome_driver):
-        try:
-            driver = launcher()
-            break
-        except WebDriverException as e:
-            logger.debug(e)
-    if driver is None:
-        raise RuntimeError(
-            "cannot load suitable webdriver; "
-            "please install Chrome/Chromium and chromedriver, or Firefox and geckodriver"
-        )
+def connect_to_daemon(path):
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def upload_through_daemon(sock, paths):
+    # Returns (number of paths, number of failed uploads). URLs are
+    # printed in input order.
+    count = 0
+    with sock:
+        with sock.makefile("wb") as wfile:
+            for path in paths:
+                request = {"id": count, "path": os.path.abspath(str(path))}
+                wfile.write(json.dumps(request).encode("utf-8") + b"\n")
+                count += 1
+        sock.shutdown(socket.SHUT_WR)
+        results = {}
+        next_id = 0
+        num_errors = 0
+        with sock.makefile("rb") as rfile:
+            for line in rfile:
+                response = json.loads(line.decode("utf-8"))
+                results[response.get("id")] = response
+                while next_id in results:
+                    response = results.pop(next_id)
+                    if "url" in response:
+                        print(response["url"], flush=True)
+                    else:
+                        logger.error("%s", response["error"])
+                        num_errors += 1
+                    next_id += 1
+        if next_id < count:
+            logger.error("connection to ghuc daemon lost")
+            num_errors += count - next_id
+    return count, num_errors
 
-    logger.info("refreshing cookie and token...")
+
+def write_metrics_file(uploader, path):
+    # JSON if the file name ends in .json, Prometheus text otherwise.
+    path = pathlib.Path(path)
     try:
-        if cookies:
-            logger.info("preparing browser session with persisted cookies...")
-            # Web driver requires navigating to the domain before adding cookies.
-            driver.get("https://github.com/404")
-            try:
-                for cookie in cookies:
-                    driver.add_cookie(cookie)
-            except WebDriverException:
-                logger.warning(
-                    "corruption in cookie jar detected; ignoring some persisted cookies"
-                )
-        logger.info("logging in...")
-        driver.get(ISSUE_URL)
-        try:
-            username_field = driver.find_element_by_css_selector("input[name=login]")
-            password_field = driver.find_element_by_css_selector("input[name=password]")
-            submit_button = driver.find_element_by_css_selector("input[type=submit]")
-            username = os.getenv("GITHUB_USERNAME")
-            if username:
-                logger.info("using username '%s' from GITHUB_USERNAME", username)
-            else:
-                username = input("GitHub username: ")
-            password = os.getenv("GITHUB_PASSWORD")
-            if password:
-                logger.info("using password from GITHUB_PASSWORD")
-            else:
-                password = getpass.getpass("Password (never stored): ")
-            username_field.send_keys(username)
-            password_field.send_keys(password)
-            submit_button.click()
-        except NoSuchElementException:
-            pass
-        try:
-            totp_field = driver.find_element_by_css_selector("input[name=otp]")
-            submit_button = driver.find_element_by_css_selector("button[type=submit]")
-            totp_secret = os.getenv("GITHUB_TOTP_SECRET")
-            if totp_secret:
-                totp = pyotp.TOTP(totp_secret).now()
-                logger.info("using TOTP %s derived from GITHUB_TOTP_SECRET", totp)
-            else:
-                totp = input("TOTP: ")
-            totp_field.send_keys(totp)
-            submit_button.click()
-        except NoSuchElementException:
-            pass
-        try:
-            # For rarely used accounts, one could be presented with a
-            # confirmation page for account recovery settings.
-            remind_me_later = driver.find_element_by_css_selector(
-                "button[type=submit][value=postponed]"
+        if path.suffix == ".json":
+            content = json.dumps(
+                uploader.metrics.as_dict(uploader.http_client), indent=2
             )
-            remind_me_later.click()
-        except NoSuchElementException:
-            pass
-        logger.info("issue page loaded")
+        else:
+            content = uploader.metrics.prometheus_text(uploader.http_client)
+        # Readable by collectors running as other users (umask permitting).
+        write_file_atomically(path, content, mode=0o666)
+    except OSError as e:
+        logger.warning("%s: failed to write metrics: %s", path, e)
 
-        try:
-            token = driver.execute_script(
-                "return document.querySelector('input[data-csrf=true]').value;"
-            )
-        except JavascriptException as e:
-            write_page_source_and_report_error(
-                driver.page_source, "JavaScript exception: %s" % e
-            )
-        if not token:
-            write_page_source_and_report_error(
-                driver.page_source, "failed to extract uploadPolicyAuthenticityToken"
-            )
-        logger.info("extracted authenticity token: %s", token)
-        logger.debug("persisting token to %s ...", token_file)
-        with token_file.open("w") as fp:
-            print(token, file=fp)
-        secure_file_permissions(token_file)
 
-        cookies = driver.get_cookies()
-        cookie_header = "; ".join(
-            "%s=%s" % (cookie["name"], cookie["value"]) for cookie in cookies
-        )
-        logger.debug("extracted cookie: %s", cookie_header)
-        logger.debug("persisting cookies to %s ...", cookie_file)
-        with cookie_file.open("w") as fp:
-            json.dump(cookies, fp, indent=2)
-        secure_file_permissions(cookie_file)
+def serve(address, uploader, metrics_file=None):
+    if not hasattr(socket, "AF_UNIX"):
+        logger.critical("Unix domain sockets are not supported on this platform")
+        sys.exit(1)
+    sock = connect_to_daemon(address)
+    if sock is not None:
+        sock.close()
+        logger.critical("another ghuc daemon is already listening on %s", address)
+        sys.exit(1)
+    try:
+        # Stale socket left behind by a daemon that didn't exit cleanly.
+        os.unlink(str(address))
+    except FileNotFoundError:
+        pass
+
+    uploader.prewarm()
+    try:
+        uploader.ensure_credentials()
+    except ExtractionError:
+        logger.critical("aborting due to inability to extract credentials")
+        sys.exit(1)
 
-        logger.info("cookie and token refreshed")
-        credentials_fresh = True
+    # Only the owner may submit uploads with our credentials.
+    old_umask = os.umask(0o077)
+    try:
+        server = UploadDaemon(str(address), uploader, metrics_file=metrics_file)
+    finally:
+        os.umask(old_umask)
+    logger.info("listening on %s", address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
-        driver.quit()
+        server.server_close()
+        server.write_metrics()
+        try:
+            os.unlink(str(address))
+        except OSError:
+            pass
 
 
-def detect_mime_type(path):
-    path = str(path)
-    if magic:
-        return magic.from_file(path, mime=True)
+def parse_size(s):
+    # "1048576", "1024K", "1M", "1.5G", etc. Raises ValueError.
+    s = s.strip().upper()
+    if s.endswith("B"):
+        s = s[:-1]
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if s and s[-1] in units:
+        size = int(float(s[:-1]) * units[s[-1]])
     else:
-        return mimetypes.guess_type(path)[0]
+        size = int(s)
+    if size < 0:
+        raise ValueError("negative size")
+    return size
 
 
-def upload_asset(http_client, path):
-    if not path.is_file():
-        logger.error("%s: does not exist", path)
-        raise UploadError
-    name = path.name
-    size = path.stat().st_size
-    content_type = detect_mime_type(path)
-    if not content_type:
-        logger.error("%s: cannot detect or guess MIME type", path)
-        raise UploadError
+def walk_files(directory):
+    # Lazily yields DirEntry objects for the files under directory,
+    # recursively, depth first and in name order within each directory.
+    # Symlinks to directories are not followed.
+    stack = [str(directory)]
+    while stack:
+        top = stack.pop()
+        try:
+            entries = sorted(os.scandir(top), key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning("%s: %s", top, e)
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
 
-    try:
-        while True:
-            logger.debug("%s: retrieving asset upload credentials...", path)
-            r = http_client.request(
-                "POST",
-                "https://github.com/upload/policies/assets",
-                headers={"Accept": "application/json", "Cookie": cookie_header},
-                fields={
-                    "name": name,
-                    "size": size,
-                    "content_type": content_type,
-                    "authenticity_token": token,
-                    "repository_id": repository_id,
-                },
-            )
-            data = r.data.decode("utf-8")
-            logger.debug("/upload/policies/assets: HTTP %d: %s", r.status, data)
-            if r.status == 422:
-                if r.headers["Content-Type"].startswith("text/html"):
-                    if credentials_fresh:
-                        logger.error(
-                            "%s: unexpected 422 text/html response from /upload/policies/assets",
-                            path,
-                        )
-                        raise UploadError
-                    else:
-                        logger.warning("cookie and/or token appear stale")
-                        refresh_cookie_and_token()
-                        continue
-                if (
-                    r.headers["Content-Type"].startswith("application/json")
-                    and "content_type" in data
-                ):
-                    logger.error("%s: unsupported MIME type %s", path, content_type)
+
+def expand_paths(paths, max_size=None, extensions=SUPPORTED_EXTENSIONS):
+    """Expands directories and glob patterns in paths, lazily.
+
+    Directories (including those matched by globs) are walked recursively.
+    Files found this way are skipped unless their extension is one of
+    extensions (unless None) and, if max_size is given, their size is at
+    most max_size; all of this happens before any network I/O. Other paths are
+    passed through as is, so that explicitly named files are always
+    attempted (and fail with a proper error if unsupported or missing).
+    """
+
+    def accept(path, size):
+        if extensions is not None and path.suffix.lower() not in extensions:
+            logger.debug("%s: skipped: unsupported file type", path)
+            return False
+        if max_size is not None and size > max_size:
+            logger.debug("%s: skipped: larger than %d bytes", path, max_size)
+            return False
+        return True
+
+    def walk(directory):
+        for entry in walk_files(directory):
+            path = pathlib.Path(entry.path)
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            if accept(path, size):
+                yield path
+
+    for path in paths:
+        if path.is_dir():
+            yield from walk(path)
+        elif not path.exists() and re.search(r"[*?[]", str(path)):
+            matched = False
+            for match in glob.iglob(str(path), recursive=True):
+                matched = True
+                match = pathlib.Path(match)
+                if match.is_dir():
+                    yield from walk(match)
                 else:
-                    logger.error(
-                        "%s: 422 response from /upload/policies/assets: %s", path, data
-                    )
-                raise UploadError
-            assert r.status == 201, (
-                "/upload/policies/assets: expected HTTP 201, got %d" % r.status
-            )
-            obj = json.loads(data, object_pairs_hook=collections.OrderedDict)
-            asset_url = obj["asset"]["href"]
+                    try:
+                        size = match.stat().st_size
+                    except OSError:
+                        continue
+                    if accept(match, size):
+                        yield match
+            if not matched:
+                logger.warning("%s: no matches", path)
+        else:
+            yield path
 
-            logger.debug("%s: uploading...", path)
-            upload_url = obj["upload_url"]
-            form = obj["form"]
-            with path.open("rb") as fp:
-                content = fp.read()
-            form["file"] = (name, content)
-            r = http_client.request(
-                "POST", upload_url, fields=form, timeout=Timeout(connect=3.0)
-            )
-            logger.debug(
-                "%s: HTTP %d: %s", upload_url, r.status, r.data.decode("utf-8")
-            )
-            assert r.status == 204, "%s: expected HTTP 204, got %d" % (
-                upload_url,
-                r.status,
-            )
 
-            logger.debug("%s: registering asset...", path)
-            register_url = obj["asset_upload_url"]
-            absolute_register_url = urllib.parse.urljoin(
-                "https://github.com/", register_url
-            )
-            r = http_client.request(
-                "PUT",
-                absolute_register_url,
-                headers={"Accept": "application/json", "Cookie": cookie_header},
-                fields={"authenticity_token": obj["asset_upload_authenticity_token"]},
-            )
-            logger.debug(
-                "%s: HTTP %d: %s", register_url, r.status, r.data.decode("utf-8")
-            )
-            assert r.status == 200, "%s: expected HTTP 200, got %d" % (
-                register_url,
-                r.status,
-            )
+def read_paths(fp, delimiter=b"\n"):
+    # Yields paths from a binary stream as they arrive; empty entries are
+    # skipped.
+    read = getattr(fp, "read1", fp.read)
+    buf = b""
+    while True:
+        chunk = read(65536)
+        if not chunk:
+            break
+        *entries, buf = (buf + chunk).split(delimiter)
+        for entry in entries:
+            if entry:
+                yield pathlib.Path(os.fsdecode(entry))
+    if buf:
+        yield pathlib.Path(os.fsdecode(buf))
 
-            logger.debug("%s: upload success", path)
-            print(asset_url)
-            return
-    except (HTTPError, AssertionError) as e:
-        logger.error("%s: %s", path, e)
-        raise UploadError
+
+def result_to_json(result):
+    return json.dumps(
+        collections.OrderedDict(
+            [
+                ("path", str(result.path)),
+                ("url", result.url),
+                ("size", result.size),
+                ("mime", result.mime),
+                ("sha256", result.sha256),
+                ("elapsed", round(result.elapsed, 3)),
+                ("error", str(result.error) if result.error else None),
+            ]
+        )
+    )
 
 
 def main():
+    # "ghuc serve" starts the upload daemon; anything else is a regular
+    # upload command line. (A file named "serve" can be passed as ./serve.)
+    serve_mode = sys.argv[1:2] == ["serve"]
+    argv = sys.argv[2:] if serve_mode else sys.argv[1:]
+
     parser = argparse.ArgumentParser(
-        description="Uploads images/documents to GitHub as issue attachments.\n"
-        "See https://github.com/zmwangx/ghuc for detailed documentation."
+        prog="ghuc serve" if serve_mode else None,
+        description=(
+            "Runs a ghuc daemon serving uploads over a Unix domain socket.\n"
+            if serve_mode
+            else "Uploads images/documents to GitHub as issue attachments.\n"
+        )
+        + "See https://github.com/zmwangx/ghuc for detailed documentation.",
     )
     parser.add_argument(
         "-r",
@@ -391,6 +3627,140 @@ def main():
         help="id of repository to upload from (defaults to 1)",
     )
     parser.add_argument("-x", "--proxy", help="HTTP or SOCKS proxy")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4 if serve_mode else 1,
+        help="number of concurrent uploads (defaults to %d)" % (4 if serve_mode else 1),
+    )
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default="urllib3",
+        help="how to send requests to GitHub: urllib3 (HTTP/1.1, the default) or "
+        "http2 (multiplexed over a single connection; needs httpx[http2])",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        metavar="FILES_PER_SEC",
+        help="start at most this many uploads per second",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        type=parse_size,
+        metavar="BYTES_PER_SEC",
+        help="cap total upload bandwidth, e.g. 5M for 5 MiB/s",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        dest="profiles",
+        metavar="NAME",
+        help="upload with the credentials of profile NAME (see README); repeat "
+        "to spread uploads across several accounts",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not look up or record uploads in the local upload cache",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="check that cached URLs are still reachable before reusing them",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="recompress PNG and JPEG images (losslessly) before uploading, if that "
+        "makes them smaller; needs Pillow",
+    )
+    parser.add_argument(
+        "--max-dimension",
+        type=int,
+        metavar="PIXELS",
+        help="scale down PNG and JPEG images larger than PIXELS in either "
+        "direction; implies --optimize",
+    )
+    parser.add_argument(
+        "--strip-metadata",
+        action="store_true",
+        help="drop EXIF data and text chunks from PNG and JPEG images; implies "
+        "--optimize",
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="compress .log and .txt files of 1 MiB or more with gzip before "
+        "uploading (as NAME.gz)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="download each file after uploading it and check its SHA-256 digest; "
+        "mismatches count as failed uploads",
+    )
+    parser.add_argument(
+        "--socket",
+        type=pathlib.Path,
+        default=socket_file,
+        help="path of the daemon socket (defaults to ghuc.sock in the data directory)",
+    )
+    if not serve_mode:
+        parser.add_argument(
+            "--no-daemon",
+            action="store_true",
+            help="upload directly even if a ghuc daemon is running",
+        )
+        parser.add_argument(
+            "--from-stdin",
+            action="store_true",
+            help="read paths from stdin, one per line, and start uploading as they "
+            "arrive; implies --ndjson",
+        )
+        parser.add_argument(
+            "-0",
+            "--null",
+            action="store_true",
+            help="with --from-stdin, paths are separated by NUL instead of newline",
+        )
+        parser.add_argument(
+            "--ndjson",
+            action="store_true",
+            help="print one JSON object per file as each upload finishes",
+        )
+        parser.add_argument(
+            "--bundle",
+            metavar="NAME.zip",
+            help="upload all files as a single ZIP archive named NAME.zip",
+        )
+        parser.add_argument(
+            "--journal",
+            type=pathlib.Path,
+            metavar="FILE",
+            help="record finished uploads in FILE, and skip files it records as "
+            "uploaded (for resuming interrupted runs)",
+        )
+        parser.add_argument(
+            "--max-size",
+            type=parse_size,
+            metavar="SIZE",
+            help="skip files larger than SIZE (e.g. 10M) found in directories and "
+            "globs",
+        )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print per-phase timings and connection stats to stderr when done",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=pathlib.Path,
+        help="write metrics to this file when done, as Prometheus text (or JSON "
+        "if the name ends in .json)",
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_true", help="set logging level to ERROR"
     )
@@ -408,8 +3778,38 @@ def main():
         help="add extra browser options to work around problems in containers",
     )
     parser.add_argument("--version", action="version", version=__version__)
-    parser.add_argument("paths", type=pathlib.Path, nargs="+", metavar="PATH")
-    args = parser.parse_args()
+    if not serve_mode:
+        parser.add_argument(
+            "paths",
+            type=pathlib.Path,
+            nargs="*",
+            metavar="PATH",
+            help="file, directory (searched recursively for supported files) or "
+            "glob pattern",
+        )
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+    if args.max_dimension is not None and args.max_dimension < 1:
+        parser.error("--max-dimension must be a positive integer")
+    if args.max_rate is not None and args.max_rate <= 0:
+        parser.error("--max-rate must be positive")
+    if args.max_bandwidth is not None and args.max_bandwidth <= 0:
+        parser.error("--max-bandwidth must be positive")
+    if not serve_mode:
+        if args.from_stdin and args.paths:
+            parser.error("paths cannot be given with --from-stdin")
+        if not args.from_stdin and not args.paths:
+            parser.error("no paths given")
+        if args.null and not args.from_stdin:
+            parser.error("--null requires --from-stdin")
+        if args.bundle and not args.bundle.lower().endswith(".zip"):
+            parser.error("--bundle name must end in .zip")
+        if args.bundle and args.journal:
+            parser.error("--journal cannot be used with --bundle")
+        args.ndjson = args.ndjson or args.from_stdin
+
+    configure_logging()
 
     if args.debug:
         custom_level = logging.DEBUG
@@ -421,51 +3821,153 @@ def main():
         logger.setLevel(custom_level)
         logger.handlers[0].setLevel(custom_level)
 
-    global repository_id
-    global proxy
-    global headless
-    global container
-
-    repository_id = args.repository_id
-    proxy = args.proxy or os.getenv("https_proxy")
-    if proxy and not re.match(r"^(https?|socks(4a?|5h?))://", proxy):
-        proxy = "http://%s" % proxy
-    if proxy:
-        logger.debug("using proxy %s", proxy)
-    headless = not args.gui
-    container = args.container
-
-    common_http_options = dict(cert_reqs="CERT_REQUIRED", timeout=3.0)
-    if not proxy:
-        http_client = PoolManager(**common_http_options)
-    elif proxy.startswith("http"):
-        http_client = ProxyManager(proxy, **common_http_options)
-    elif proxy.startswith("socks"):
-        if SOCKSProxyManager:
-            http_client = SOCKSProxyManager(proxy, **common_http_options)
-        else:
-            logger.critical("your urllib3 installation does not support SOCKS proxies")
-            sys.exit(1)
-    else:
-        logger.critical("unrecognized proxy type %s", proxy)
-        sys.exit(1)
+    # The daemon protocol only carries URLs and errors, so streaming and
+    # NDJSON modes always upload directly; so do bundles, journaled runs,
+    # and uploads with specific profiles, since the daemon uploads with its
+    # own. The daemon also uploads with its own settings and keeps its own
+    # metrics, so any option that would otherwise be silently ignored
+    # makes the client upload directly.
+    direct_options = (
+        "ndjson",
+        "bundle",
+        "journal",
+        "profiles",
+        "repository_id",
+        "proxy",
+        "transport",
+        "max_rate",
+        "max_bandwidth",
+        "no_cache",
+        "revalidate",
+        "optimize",
+        "max_dimension",
+        "strip_metadata",
+        "gzip",
+        "verify",
+        "stats",
+        "metrics_file",
+    )
+    if (
+        not serve_mode
+        and not args.no_daemon
+        and all(
+            getattr(args, dest) == parser.get_default(dest) for dest in direct_options
+        )
+    ):
+        sock = connect_to_daemon(args.socket)
+        if sock is not None:
+            logger.debug("forwarding uploads to daemon at %s", args.socket)
+            count, num_errors = upload_through_daemon(
+                sock, expand_paths(args.paths, max_size=args.max_size)
+            )
+            if count > 1 and num_errors > 0:
+                logger.warning("%d failed uploads", num_errors)
+            sys.exit(0 if num_errors == 0 else 1)
 
     try:
-        load_cookie_and_token()
-        count = len(args.paths)
-        num_errors = 0
-        for path in args.paths:
-            try:
-                upload_asset(http_client, path)
-            except UploadError:
-                num_errors += 1
-        if count > 1 and num_errors > 0:
-            logger.warning("%d failed uploads", num_errors)
-        sys.exit(0 if num_errors == 0 else 1)
-    except ExtractionError:
-        logger.critical("aborting due to inability to extract credentials")
+        uploader = Uploader(
+            repository_id=args.repository_id,
+            proxy=args.proxy or os.getenv("https_proxy"),
+            jobs=args.jobs,
+            use_cache=not args.no_cache,
+            revalidate_cache=args.revalidate,
+            headless=not args.gui,
+            container=args.container,
+            optimize=args.optimize,
+            max_dimension=args.max_dimension,
+            strip_metadata=args.strip_metadata,
+            max_rate=args.max_rate,
+            max_bandwidth=args.max_bandwidth,
+            profiles=args.profiles,
+            verify=args.verify,
+            transport=args.transport,
+            compress_text=args.gzip,
+            # For testing against a mock server; see mockgithub.py.
+            github_url=os.getenv("GHUC_GITHUB_URL") or GITHUB_URL,
+        )
+    except ValueError as e:
+        logger.critical("%s", e)
         sys.exit(1)
 
+    def report():
+        if args.stats:
+            print(uploader.metrics.summary(uploader.http_client), file=sys.stderr)
+        if args.metrics_file:
+            write_metrics_file(uploader, args.metrics_file)
+
+    with uploader:
+        if serve_mode:
+            try:
+                serve(args.socket, uploader, metrics_file=args.metrics_file)
+            finally:
+                # The daemon writes the metrics file itself.
+                if args.stats:
+                    print(
+                        uploader.metrics.summary(uploader.http_client), file=sys.stderr
+                    )
+            return
+
+        if args.from_stdin:
+            paths = read_paths(sys.stdin.buffer, b"\0" if args.null else b"\n")
+        else:
+            paths = args.paths
+        # Bundles can hold files of any type.
+        paths = expand_paths(
+            paths,
+            max_size=args.max_size,
+            extensions=None if args.bundle else SUPPORTED_EXTENSIONS,
+        )
+
+        journal = None
+        if args.journal:
+            try:
+                journal = UploadJournal(args.journal)
+            except OSError as e:
+                logger.critical("%s: %s", args.journal, e)
+                sys.exit(1)
+
+        try:
+            count = 0
+            num_errors = 0
+            # URLs are printed in input order, regardless of completion order;
+            # NDJSON results are printed as soon as they are available.
+            if args.bundle:
+                results = [
+                    uploader._upload_result(
+                        pathlib.Path(args.bundle),
+                        lambda _, info: uploader.upload_bundle(
+                            paths, args.bundle, info
+                        ),
+                    )
+                ]
+            else:
+                results = uploader.upload_many(
+                    paths, ordered=not args.ndjson, journal=journal
+                )
+            for result in results:
+                count += 1
+                if result.error:
+                    logger.error("%s", result.error)
+                    num_errors += 1
+                if args.ndjson:
+                    print(result_to_json(result), flush=True)
+                elif not result.error:
+                    print(result.url, flush=True)
+            if count > 1 and num_errors > 0:
+                logger.warning("%d failed uploads", num_errors)
+            if journal is not None:
+                journal.close()
+            report()
+            sys.exit(0 if num_errors == 0 else 1)
+        except ExtractionError:
+            logger.critical("aborting due to inability to extract credentials")
+            report()
+            sys.exit(1)
+        finally:
+            # Interrupted runs leave the journal uncompacted (no-op otherwise).
+            if journal is not None:
+                journal.close(compact=False)
+
 
 if __name__ == "__main__":
     main()
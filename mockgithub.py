@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the parts of GitHub ghuc talks to.
+
+Implements the login page, the issue page with a CSRF token, the upload
+policy endpoint (including 422 responses for stale tokens and unsupported
+content types), an S3-style form POST endpoint, asset registration and
+download of registered assets. Latency and bandwidth are configurable, so
+that upload performance can be measured and regression-tested offline
+(see bench.py).
+
+Point ghuc at a running server with the GHUC_GITHUB_URL environment
+variable, or the github_url argument of ghuc.Uploader.
+
+Run standalone with
+
+    python mockgithub.py [--port PORT] [--latency SECONDS] [--bandwidth BYTES_PER_SEC]
+
+and log in with any username and password.
+"""
+
+import argparse
+import base64
+import email.parser
+import email.policy
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+ISSUE_PAGE_PATH = "/mojombo/grit/issues/1"
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta name="user-login" content=""><title>Sign in</title></head>
+<body>
+<form action="/session" method="post">
+<input type="hidden" name="return_to" value="{return_to}">
+<input type="text" name="login">
+<input type="password" name="password">
+<input type="submit" name="commit" value="Sign in">
+</form>
+</body>
+</html>
+"""
+
+ISSUE_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta name="user-login" content="{login}"><title>Issue #1</title></head>
+<body>
+<form action="/mojombo/grit/issue_comments" method="post">
+<input type="hidden" data-csrf="true" name="authenticity_token" value="{token}">
+<textarea name="comment[body]"></textarea>
+</form>
+</body>
+</html>
+"""
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MockGitHub:
+    """Mock GitHub server running in a background thread.
+
+    latency is added to every response (in seconds); bandwidth, if set,
+    caps the rate at which each upload body is received (in bytes per
+    second). rejected_types are content types refused by the upload policy
+    endpoint, like image/webp on GitHub.
+
+    session and token are the currently valid session cookie value and
+    authenticity token; expire_token invalidates the token, and
+    expire_session invalidates both. throttle makes the upload policy
+    endpoint respond with 429 (with an optional Retry-After) for a number
+    of requests. hide_assets makes assets 404 for a number of requests,
+    like a CDN that hasn't caught up yet, and with corrupt_assets set,
+    assets are served with their first byte flipped. With issue_redirect
+    set, the issue page redirects there. fail makes an
+    endpoint ("policy", "s3" or "register") respond with a server error for
+    a number of requests (with an optional Retry-After; S3 503s are
+    SlowDown errors). Upload policies expire after policy_ttl seconds.
+    Uploaded files are kept on disk in a temporary directory until stop.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        bandwidth=None,
+        rejected_types=("image/webp",),
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rejected_types = set(rejected_types)
+        self.session = uuid.uuid4().hex
+        self.token = uuid.uuid4().hex
+        self.assets = {}
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self._next_asset_id = 1
+        self._throttled_requests = 0
+        self._retry_after = None
+        self._hidden_requests = 0
+        self._failures = {}
+        self.policy_ttl = 1800
+        self.corrupt_assets = False
+        self.issue_redirect = None
+        self._storage = tempfile.mkdtemp(prefix="mockgithub-")
+        self._server = ThreadingHTTPServer((host, port), MockGitHubHandler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+        shutil.rmtree(self._storage, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def expire_token(self):
+        with self.lock:
+            self.token = uuid.uuid4().hex
+
+    def expire_session(self):
+        with self.lock:
+            self.session = uuid.uuid4().hex
+            self.token = uuid.uuid4().hex
+
+    def throttle(self, requests, retry_after=None):
+        with self.lock:
+            self._throttled_requests = requests
+            self._retry_after = retry_after
+
+    def take_throttle(self):
+        # Returns None if the request may proceed, or headers for a 429
+        # response otherwise.
+        with self.lock:
+            if self._throttled_requests <= 0:
+                return None
+            self._throttled_requests -= 1
+            if self._retry_after is None:
+                return {}
+            return {"Retry-After": str(self._retry_after)}
+
+    def fail(self, endpoint, requests, status=500, retry_after=None):
+        with self.lock:
+            self._failures[endpoint] = (requests, status, retry_after)
+
+    def take_failure(self, endpoint):
+        # Returns the status and headers to fail the request with, or None.
+        with self.lock:
+            requests, status, retry_after = self._failures.get(
+                endpoint, (0, None, None)
+            )
+            if requests <= 0:
+                return None
+            self._failures[endpoint] = (requests - 1, status, retry_after)
+            if retry_after is None:
+                return status, {}
+            return status, {"Retry-After": str(retry_after)}
+
+    def hide_assets(self, requests):
+        with self.lock:
+            self._hidden_requests = requests
+
+    def take_hidden(self):
+        with self.lock:
+            if self._hidden_requests <= 0:
+                return False
+            self._hidden_requests -= 1
+            return True
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def new_asset(self, name, size, content_type):
+        with self.lock:
+            asset_id = self._next_asset_id
+            self._next_asset_id += 1
+            asset = {
+                "id": asset_id,
+                "name": name,
+                "size": size,
+                "content_type": content_type,
+                "path": os.path.join(self._storage, str(asset_id)),
+                "upload_token": uuid.uuid4().hex,
+                "uploaded": False,
+                "registered": False,
+                "sha256": None,
+            }
+            self.assets[asset_id] = asset
+            return asset
+
+
+class MockGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def log_message(self, format, *args):
+        pass
+
+    # Helpers
+
+    def cookies(self):
+        cookies = {}
+        for pair in (self.headers.get("Cookie") or "").split(";"):
+            name, _, value = pair.strip().partition("=")
+            if name:
+                cookies[name] = value
+        return cookies
+
+    def logged_in(self):
+        return self.cookies().get("user_session") == self.mock.session
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def form(self, body):
+        # Parses multipart/form-data or application/x-www-form-urlencoded
+        # fields (small bodies only).
+        content_type = self.headers.get("Content-Type") or ""
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b"Content-Type: " + content_type.encode("utf-8") + b"\r\n\r\n" + body
+            )
+            return {
+                part.get_param("name", header="content-disposition"): part.get_content()
+                for part in message.iter_parts()
+            }
+        return dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+
+    def respond(self, status, body=b"", content_type="text/html", headers=None):
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def respond_json(self, status, obj, headers=None):
+        self.respond(
+            status, json.dumps(obj), "application/json; charset=utf-8", headers
+        )
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or {})
+        headers["Location"] = location
+        self.respond(302, headers=headers)
+
+    # Routing
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/login":
+            self.mock.count("login")
+            return_to = dict(urllib.parse.parse_qsl(url.query)).get("return_to", "/")
+            if self.logged_in():
+                self.redirect(return_to)
+            else:
+                self.respond(200, LOGIN_PAGE.format(return_to=return_to))
+        elif url.path == ISSUE_PAGE_PATH:
+            self.mock.count("issue")
+            if self.mock.issue_redirect:
+                self.redirect(self.mock.issue_redirect)
+            elif self.logged_in():
+                self.respond(
+                    200, ISSUE_PAGE.format(login="ghuc", token=self.mock.token)
+                )
+            else:
+                self.redirect("/login?return_to=" + urllib.parse.quote(url.path, ""))
+        elif url.path.startswith("/assets/"):
+            self.serve_asset(url.path)
+        else:
+            self.respond(404, "Not Found", "text/plain")
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/session":
+            self.login()
+        elif path == "/upload/policies/assets":
+            self.upload_policy()
+        elif path == "/s3":
+            self.s3_upload()
+        else:
+            self.read_body()
+            self.respond(404, "Not Found", "text/plain")
+
+    def do_PUT(self):
+        match = re.match(
+            r"^/upload/assets/(\d+)$", urllib.parse.urlsplit(self.path).path
+        )
+        if match:
+            self.register_asset(int(match.group(1)))
+        else:
+            self.read_body()
+            self.respond(404, "Not Found", "text/plain")
+
+    # Endpoints
+
+    def login(self):
+        self.mock.count("session")
+        form = self.form(self.read_body())
+        if not form.get("login") or not form.get("password"):
+            self.respond(200, LOGIN_PAGE.format(return_to=form.get("return_to", "/")))
+            return
+        self.redirect(
+            form.get("return_to") or "/",
+            headers={
+                "Set-Cookie": "user_session=%s; path=/; HttpOnly" % self.mock.session
+            },
+        )
+
+    def upload_policy(self):
+        self.mock.count("policy")
+        form = self.form(self.read_body())
+        failure = self.mock.take_failure("policy")
+        if failure is not None:
+            self.respond(failure[0], "Server Error", "text/plain", failure[1])
+            return
+        throttle_headers = self.mock.take_throttle()
+        if throttle_headers is not None:
+            self.respond_json(
+                429,
+                {"message": "You have exceeded a secondary rate limit."},
+                headers=throttle_headers,
+            )
+            return
+        if not self.logged_in() or form.get("authenticity_token") != self.mock.token:
+            # GitHub responds to stale credentials with an HTML error page.
+            self.respond(422, "<html><body>Unprocessable Entity</body></html>")
+            return
+        content_type = form.get("content_type")
+        if content_type in self.mock.rejected_types:
+            self.respond_json(
+                422,
+                {
+                    "message": "Validation Failed",
+                    "errors": [
+                        {
+                            "resource": "Asset",
+                            "code": "invalid",
+                            "field": "content_type",
+                        }
+                    ],
+                },
+            )
+            return
+        name = form["name"]
+        asset = self.mock.new_asset(name, int(form["size"]), content_type)
+        base = self.mock.url
+        expiration = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + self.mock.policy_ttl)
+        )
+        policy = base64.b64encode(
+            json.dumps({"expiration": expiration}).encode("utf-8")
+        ).decode("ascii")
+        self.respond_json(
+            201,
+            {
+                "upload_url": base + "/s3",
+                "upload_authenticity_token": self.mock.token,
+                "asset_upload_url": "/upload/assets/%d" % asset["id"],
+                "asset_upload_authenticity_token": asset["upload_token"],
+                "form": {
+                    "key": "%d/%s" % (asset["id"], name),
+                    "acl": "public-read",
+                    "policy": policy,
+                    "Content-Type": content_type,
+                },
+                "asset": {
+                    "id": asset["id"],
+                    "name": name,
+                    "size": asset["size"],
+                    "content_type": content_type,
+                    "href": "%s/assets/%d/%s"
+                    % (base, asset["id"], urllib.parse.quote(name)),
+                },
+            },
+        )
+
+    def s3_upload(self):
+        # Streams the body to disk, assuming (like S3) that the file is the
+        # last field of the form.
+        self.mock.count("s3")
+        length = int(self.headers.get("Content-Length") or 0)
+        content_type = self.headers.get("Content-Type") or ""
+        boundary = content_type.partition("boundary=")[2].strip('"').encode("utf-8")
+        tail = b"\r\n--" + boundary + b"--\r\n"
+        received = 0
+        start = time.monotonic()
+
+        def read(n):
+            nonlocal received
+            data = self.rfile.read(n)
+            received += len(data)
+            if self.mock.bandwidth:
+                # Sleep until we're back under the bandwidth cap.
+                ahead = received / self.mock.bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            return data
+
+        head = b""
+        while True:
+            chunk = read(min(4096, length - received))
+            if not chunk:
+                self.respond(400, "Malformed Body", "text/plain")
+                return
+            head += chunk
+            match = re.search(
+                rb'name="file"[^\r\n]*\r\n(?:[^\r\n]+\r\n)*\r\n', head, re.DOTALL
+            )
+            if match:
+                break
+        fields = self.form(head[: head.rfind(b"--" + boundary, 0, match.start())])
+        key = fields.get("key", "")
+        asset_id = int(key.partition("/")[0] or 0)
+        asset = self.mock.assets.get(asset_id)
+        if asset is None:
+            self.respond(
+                403, "<Error><Code>AccessDenied</Code></Error>", "application/xml"
+            )
+            return
+        data = head[match.end() :]
+        remaining = length - received + len(data) - len(tail)
+        h = hashlib.sha256()
+        size = 0
+        with open(asset["path"], "wb") as fp:
+            while remaining > 0:
+                if not data:
+                    data = read(min(1 << 16, length - received))
+                    if not data:
+                        break
+                piece = data[:remaining]
+                data = data[remaining:]
+                fp.write(piece)
+                h.update(piece)
+                size += len(piece)
+                remaining -= len(piece)
+        # Drain the rest of the body (the closing boundary).
+        while received < length:
+            if not read(min(1 << 16, length - received)):
+                break
+        failure = self.mock.take_failure("s3")
+        if failure is not None:
+            status, headers = failure
+            code = "SlowDown" if status == 503 else "InternalError"
+            self.respond(
+                status,
+                "<Error><Code>%s</Code></Error>" % code,
+                "application/xml",
+                headers,
+            )
+            return
+        if size != asset["size"]:
+            self.respond(
+                400, "<Error><Code>IncompleteBody</Code></Error>", "application/xml"
+            )
+            return
+        asset["sha256"] = h.hexdigest()
+        asset["uploaded"] = True
+        self.respond(204)
+
+    def register_asset(self, asset_id):
+        self.mock.count("register")
+        form = self.form(self.read_body())
+        failure = self.mock.take_failure("register")
+        if failure is not None:
+            self.respond(failure[0], "Server Error", "text/plain", failure[1])
+            return
+        asset = self.mock.assets.get(asset_id)
+        if (
+            asset is None
+            or not self.logged_in()
+            or form.get("authenticity_token") != asset["upload_token"]
+        ):
+            self.respond(422, "<html><body>Unprocessable Entity</body></html>")
+            return
+        if not asset["uploaded"]:
+            self.respond_json(422, {"message": "upload not found"})
+            return
+        asset["registered"] = True
+        self.respond_json(
+            200,
+            {
+                "id": asset["id"],
+                "name": asset["name"],
+                "size": asset["size"],
+                "content_type": asset["content_type"],
+                "href": "%s/assets/%d/%s"
+                % (self.mock.url, asset["id"], urllib.parse.quote(asset["name"])),
+            },
+        )
+
+    def serve_asset(self, path):
+        self.mock.count("asset")
+        match = re.match(r"^/assets/(\d+)/", path)
+        asset = self.mock.assets.get(int(match.group(1))) if match else None
+        if asset is None or not asset["registered"] or self.mock.take_hidden():
+            self.respond(404, "Not Found", "text/plain")
+            return
+        with open(asset["path"], "rb") as fp:
+            content = fp.read()
+        if self.mock.corrupt_assets and content:
+            content = bytes([content[0] ^ 0xFF]) + content[1:]
+        self.respond(200, content, asset["content_type"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock GitHub server for ghuc.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to each response"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, help="upload bandwidth cap in bytes per second"
+    )
+    args = parser.parse_args()
+    mock = MockGitHub(args.host, args.port, args.latency, args.bandwidth)
+    print("listening on %s" % mock.url, flush=True)
+    print("session cookie: user_session=%s" % mock.session, flush=True)
+    mock.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -47,5 +47,9 @@ setuptools.setup(
         "urllib3[secure,socks]",
         "xdgappdirs>=1.4.5",
     ],
-    extras_require={"test": ["Pillow", "pytest"]},
+    extras_require={
+        "optimize": ["Pillow"],
+        "http2": ["httpx[http2]"],
+        "test": ["Pillow", "pytest"],
+    },
 )
@@ -1,16 +1,26 @@
+import gzip
 import hashlib
+import io
+import json
 import os
 import random
+import re
 import pathlib
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zipfile
 
 import pytest
 import urllib3
+import urllib3._collections
 from PIL import Image
 
+import ghuc
+import mockgithub
+
 
 HERE = pathlib.Path(__file__).parent.resolve()
 GHUC = HERE / "ghuc.py"
@@ -41,11 +51,6 @@ def execution_env():
     if sys.platform == "win32":
         pytest.skip("xdgappdirs does not respect XDG_* on win32; tests disabled")
 
-    # Credentials must be specified in env vars.
-    for env_var in ("GITHUB_USERNAME", "GITHUB_PASSWORD", "GITHUB_TOTP_SECRET"):
-        if not os.getenv(env_var):
-            pytest.fail("%s required" % env_var)
-
     with tempfile.TemporaryDirectory() as tmpdir:
         os.environ["XDG_CONFIG_HOME"] = tmpdir
         os.environ["XDG_DATA_HOME"] = tmpdir
@@ -53,6 +58,14 @@ def execution_env():
         yield
 
 
+@pytest.fixture(scope="session")
+def credentials():
+    # Credentials must be specified in env vars.
+    for env_var in ("GITHUB_USERNAME", "GITHUB_PASSWORD", "GITHUB_TOTP_SECRET"):
+        if not os.getenv(env_var):
+            pytest.fail("%s required" % env_var)
+
+
 @pytest.fixture(scope="session")
 def random_image():
     return Image.frombytes(
@@ -84,12 +97,12 @@ def webp_file(random_image):
         yield f
 
 
-# ghuc.py is not reentrant (in that refresh_cookie_and_token being
-# called after a 422 can only happen once), so instead of importing the
-# module and calling the main function, we have to run it in a
-# subprocess.
+# Run ghuc in a subprocess to exercise the command line interface end to
+# end, including the handling of persisted credentials across runs.
 def run_ghuc_and_verify(good_files, bad_files):
-    cmdline = [str(GHUC)]
+    # Without the upload cache, every run goes through the upload policy
+    # request, and with it the credential checks and refreshes under test.
+    cmdline = [str(GHUC), "--no-cache"]
     if os.getenv("CONTAINER"):
         cmdline.append("--container")
     cmdline.extend(f.path for f in good_files)
@@ -134,7 +147,7 @@ def run_ghuc_and_verify(good_files, bad_files):
         assert "unsupported MIME type" in stderr_data
 
 
-def test_ghuc(png_file, jpeg_file, pdf_file, webp_file):
+def test_ghuc(credentials, png_file, jpeg_file, pdf_file, webp_file):
     print("[1] initial run", file=sys.stderr)
     run_ghuc_and_verify([png_file, jpeg_file, pdf_file], [])
 
@@ -152,3 +165,858 @@ def test_ghuc(png_file, jpeg_file, pdf_file, webp_file):
         fp.seek(0)
         fp.write("b" if first_char == "a" else "a")
     run_ghuc_and_verify([png_file], [])
+
+
+def test_multipart_file_body(png_file):
+    form = {"key": "uploads/1", "acl": "public-read", "size": 42}
+    with ghuc.MultipartFileBody(form, "file", "image.png", png_file.path) as body:
+        assert body.sha256 is None
+        streamed = body.read()
+        # urllib3 rewinds the body before retrying.
+        body.seek(0)
+        assert body.read() == streamed
+        assert body.sha256 == png_file.sha256
+    with open(png_file.path, "rb") as fp:
+        fields = dict(form, file=("image.png", fp.read()))
+    expected, content_type = urllib3.encode_multipart_formdata(
+        fields, boundary=body.boundary
+    )
+    assert streamed == expected
+    assert body.content_type == content_type
+    assert body.content_length == len(expected)
+
+
+def test_upload_cache(tmp_path):
+    cache = ghuc.UploadCache(tmp_path / "cache.sqlite3", max_entries=2)
+    keys = [("%064x" % i, 100, "image/png", 1) for i in range(3)]
+    for i, key in enumerate(keys):
+        assert cache.lookup(key) is None
+        cache.store(key, "https://example.com/%d.png" % i)
+        assert cache.lookup(key) == "https://example.com/%d.png" % i
+    # The least recently used entry is evicted.
+    assert cache.lookup(keys[0]) is None
+    cache.invalidate(keys[1])
+    assert cache.lookup(keys[1]) is None
+    assert cache.lookup(keys[2]) == "https://example.com/2.png"
+
+
+# Budget for importing ghuc (best of several runs), which is on the
+# critical path of every invocation. Eager imports took ~0.25s; with heavy
+# imports deferred it's ~0.1s.
+IMPORT_TIME_BUDGET = 0.15
+
+
+def test_import_time(tmp_path):
+    script = """
+import json, sys, time
+start = time.perf_counter()
+import ghuc
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+    env = dict(os.environ, XDG_DATA_HOME=str(tmp_path))
+    best = None
+    for _ in range(5):
+        # -E: ignore PYTHON* variables, e.g. PYTHONDONTWRITEBYTECODE, which
+        # would have ghuc compiled from source on every run.
+        output = subprocess.check_output(
+            [sys.executable, "-E", "-c", script], cwd=str(HERE), env=env
+        )
+        result = json.loads(output.decode("utf-8"))
+        best = result["elapsed"] if best is None else min(best, result["elapsed"])
+        for module in (
+            "selenium",
+            "pyotp",
+            "magic",
+            "socks",
+            "logging.config",
+            "html.parser",
+            "http.cookies",
+            "socketserver",
+            "sqlite3",
+        ):
+            assert module not in result["modules"], "%s imported eagerly" % module
+    assert not tmp_path.joinpath("ghuc").exists(), "data dir created on import"
+    print("import ghuc: %.1fms" % (best * 1000), file=sys.stderr)
+    assert best < IMPORT_TIME_BUDGET
+
+
+class FakeUploader:
+    jobs = 4
+
+    def upload(self, path, info=None):
+        if path.name == "bad.png":
+            raise ghuc.UploadError("%s: unsupported MIME type" % path)
+        # Complete out of order.
+        time.sleep(0.1 if path.name == "a.png" else 0)
+        return "https://example.com/%s" % path.name
+
+
+def test_daemon(tmp_path, capsys):
+    address = str(tmp_path / "ghuc.sock")
+    server = ghuc.UploadDaemon(address, FakeUploader())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        sock = ghuc.connect_to_daemon(address)
+        paths = [pathlib.Path(p) for p in ("a.png", "bad.png", "b.png")]
+        assert ghuc.upload_through_daemon(sock, paths) == (3, 1)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    urls = capsys.readouterr().out.splitlines()
+    assert urls == ["https://example.com/a.png", "https://example.com/b.png"]
+
+
+def test_daemon_skipped_for_client_options(tmp_path, monkeypatch):
+    connections = []
+
+    def connect_to_daemon(address):
+        connections.append(address)
+
+    def uploader(**kwargs):
+        raise ValueError("uploading directly")
+
+    monkeypatch.setattr(ghuc, "connect_to_daemon", connect_to_daemon)
+    monkeypatch.setattr(ghuc, "Uploader", uploader)
+    for options in (
+        [],
+        ["--verify"],
+        ["--gzip"],
+        ["--strip-metadata"],
+        ["-r", "42"],
+        ["--no-cache"],
+        ["--stats"],
+        ["--metrics-file", str(tmp_path / "metrics.prom")],
+    ):
+        monkeypatch.setattr(sys, "argv", ["ghuc"] + options + ["a.png"])
+        with pytest.raises(SystemExit):
+            ghuc.main()
+    assert len(connections) == 1
+
+
+def test_upload_many(tmp_path, monkeypatch):
+    uploader = ghuc.Uploader(jobs=3, data_dir=tmp_path)
+    monkeypatch.setattr(uploader, "upload", FakeUploader().upload)
+    monkeypatch.setattr(uploader, "prewarm", lambda: None)
+    paths = [pathlib.Path("%s.png" % name) for name in ("a", "b", "bad", "c")]
+    results = list(uploader.upload_many(paths, ordered=True))
+    assert [result.path for result in results] == paths
+    assert [result.url for result in results] == [
+        "https://example.com/a.png",
+        "https://example.com/b.png",
+        None,
+        "https://example.com/c.png",
+    ]
+    assert isinstance(results[2].error, ghuc.UploadError)
+    unordered = uploader.upload_many(paths)
+    assert sorted((r.path, r.url or "") for r in unordered) == sorted(
+        (r.path, r.url or "") for r in results
+    )
+
+
+def test_upload_many_streaming(tmp_path, monkeypatch):
+    uploader = ghuc.Uploader(jobs=2, data_dir=tmp_path)
+    monkeypatch.setattr(uploader, "upload", FakeUploader().upload)
+    monkeypatch.setattr(uploader, "prewarm", lambda: None)
+    more = threading.Event()
+
+    def produce():
+        yield pathlib.Path("b.png")
+        more.wait(5)
+        yield pathlib.Path("c.png")
+
+    # Finished uploads are reported while the producer is still blocked.
+    results = uploader.upload_many(produce())
+    assert next(results).url == "https://example.com/b.png"
+    more.set()
+    assert next(results).url == "https://example.com/c.png"
+    with pytest.raises(StopIteration):
+        next(results)
+
+
+def test_expand_paths(tmp_path):
+    for name, size in [
+        ("a/1.png", 10),
+        ("a/2.webp", 10),
+        ("a/b/3.PDF", 10),
+        ("a/b/big.zip", 1000),
+        ("a/c/4.txt", 10),
+        ("d/5.png", 10),
+        ("d/6.png", 10),
+        ("notes.md", 10),
+    ]:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+
+    def expand(*names):
+        paths = [tmp_path / name for name in names]
+        expanded = ghuc.expand_paths(iter(paths), max_size=100)
+        return [str(p.relative_to(tmp_path)) for p in expanded]
+
+    # Directories are walked in order and filtered; explicitly named files
+    # are passed through, even if unsupported or missing.
+    assert expand("a", "notes.md", "missing.png") == [
+        "a/1.png",
+        "a/b/3.PDF",
+        "a/c/4.txt",
+        "notes.md",
+        "missing.png",
+    ]
+    # Glob matches come in no particular order.
+    assert sorted(expand("d/*.png", "**/b", "*.md")) == [
+        "a/b/3.PDF",
+        "d/5.png",
+        "d/6.png",
+    ]
+
+
+def test_read_paths():
+    fp = io.BytesIO(b"a.png\n\nb c.png\nd.png")
+    assert list(ghuc.read_paths(fp)) == [
+        pathlib.Path(p) for p in ("a.png", "b c.png", "d.png")
+    ]
+    fp = io.BytesIO(b"a\nb.png\0c.png\0")
+    assert list(ghuc.read_paths(fp, b"\0")) == [
+        pathlib.Path(p) for p in ("a\nb.png", "c.png")
+    ]
+
+
+def test_credential_refresh_single_flight(tmp_path, monkeypatch):
+    cookies = [{"name": "user_session", "value": "s3cr3t"}]
+    store = ghuc.CredentialStore(tmp_path)
+    with store.lock():
+        assert store.save(cookies, "token1") == 1
+
+    uploader = ghuc.Uploader(data_dir=tmp_path)
+    uploader.ensure_credentials()
+    (profile,) = uploader.profiles
+    assert (profile.token, profile.generation) == ("token1", 1)
+
+    # Another process refreshes the credentials in the meantime.
+    with store.lock():
+        assert store.save(cookies, "token2") == 2
+
+    def no_browser():
+        pytest.fail("credentials refreshed twice")
+
+    monkeypatch.setattr(uploader, "_extract_cookie_and_token", no_browser)
+    assert uploader.refresh_stale_credentials("token1")
+    assert (profile.token, profile.generation) == ("token2", 2)
+    assert profile.cookie_header == "user_session=s3cr3t"
+    assert store.load() == (cookies, "token2", 2)
+
+
+def test_refresh_ahead(mock_github, tmp_path, monkeypatch, png_file):
+    monkeypatch.setattr(ghuc, "MIN_TOKEN_LIFETIME", 0)
+    monkeypatch.setattr(ghuc, "FRESH_CREDENTIALS_PERIOD", 0)
+    store = ghuc.CredentialStore(tmp_path)
+    cookies = [{"name": "user_session", "value": mock_github.session}]
+    with store.lock():
+        store.save(cookies, mock_github.token)
+    assert store.token_lifetime() is None
+    store.record_token_lifetime(100)
+    store.record_token_lifetime(10)
+    assert store.token_lifetime() == 10
+
+    # Credentials near the end of their expected life are refreshed up
+    # front.
+    issued_at = time.time() - 9
+    os.utime(str(store.token_file), (issued_at, issued_at))
+    uploader = ghuc.Uploader(data_dir=tmp_path, github_url=mock_github.url)
+    uploader.ensure_credentials()
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["credential_refreshes{http}"] == 1
+    assert store.issued_at() > issued_at + 8
+
+    # Otherwise they are refreshed in the background when due, and
+    # uploads keep going in the meantime.
+    store.record_token_lifetime(1)
+    os.utime(str(store.token_file))
+    uploader = ghuc.Uploader(
+        data_dir=tmp_path, github_url=mock_github.url, use_cache=False
+    )
+    uploader.ensure_credentials()
+    (profile,) = uploader.profiles
+    generation = profile.generation
+    deadline = time.monotonic() + 5
+    while profile.generation == generation and time.monotonic() < deadline:
+        uploader.upload(pathlib.Path(png_file.path))
+    profile.refresh_timer.cancel()
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["credential_refreshes{ahead}"] >= 1
+    assert "credential_refreshes{http}" not in counters
+    assert "retries" not in counters
+
+
+def test_wait_for_any_element():
+    from selenium.webdriver.common.by import By
+
+    class Driver:
+        def find_elements(self, by, selector):
+            assert by == By.CSS_SELECTOR
+            return ["element"] if selector == "#b" else []
+
+    assert ghuc.wait_for_any_element(Driver(), ["#a", "#b"], 1) == ("#b", "element")
+    assert ghuc.wait_for_any_element(Driver(), ["#c"], 0.1) == (None, None)
+
+
+def test_token_refresh_redirects(mock_github, tmp_path):
+    uploader = make_mock_uploader(mock_github, tmp_path)
+    uploader.load_cookie_and_token(uploader.profiles[0])
+    # The session cookie is not sent to other hosts.
+    with mockgithub.MockGitHub() as other:
+        mock_github.issue_redirect = other.url + mockgithub.ISSUE_PAGE_PATH
+        assert uploader._extract_token_over_http(uploader.profiles[0]) is None
+        assert "issue" not in other.request_counts
+    mock_github.issue_redirect = None
+    cookies, token = uploader._extract_token_over_http(uploader.profiles[0])
+    assert token == mock_github.token
+
+
+def test_issue_page_parsing():
+    parser = ghuc.IssuePageParser()
+    parser.feed(
+        '<html><head><meta name="user-login" content="octocat"></head><body>'
+        '<form><input type="hidden" data-csrf="true" value="t0k3n">'
+        '<input type="hidden" data-csrf="true" value="other"></form></body></html>'
+    )
+    assert (parser.user_login, parser.token) == ("octocat", "t0k3n")
+
+    cookies = [
+        {"name": "user_session", "value": "old"},
+        {"name": "logged_in", "value": "yes"},
+    ]
+    headers = urllib3._collections.HTTPHeaderDict()
+    headers.add("Set-Cookie", "user_session=new; path=/; secure; HttpOnly")
+    headers.add("Set-Cookie", "logged_in=; Max-Age=0")
+    headers.add("Set-Cookie", "tz=UTC; expires=Fri, 01 Jan 2100 00:00:00 GMT")
+    ghuc.merge_set_cookie_headers(cookies, headers, "github.com")
+    assert [(c["name"], c["value"]) for c in cookies] == [
+        ("user_session", "new"),
+        ("tz", "UTC"),
+    ]
+    assert "expiry" not in cookies[0]
+    assert cookies[1]["expiry"] == 4102444800
+
+
+@pytest.fixture
+def mock_github():
+    with mockgithub.MockGitHub() as mock:
+        yield mock
+
+
+def make_mock_uploader(mock, data_dir, **kwargs):
+    # Seed the data dir with a valid session but a stale token, so that the
+    # first upload goes through a (browserless) refresh.
+    store = ghuc.CredentialStore(data_dir)
+    store.directory.mkdir(parents=True, exist_ok=True)
+    with store.lock():
+        store.save([{"name": "user_session", "value": mock.session}], "stale")
+    return ghuc.Uploader(data_dir=data_dir, github_url=mock.url, **kwargs)
+
+
+def test_upload_against_mock(
+    mock_github, tmp_path, monkeypatch, png_file, pdf_file, webp_file
+):
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False)
+    for f in (png_file, pdf_file):
+        url = uploader.upload(pathlib.Path(f.path))
+        assert hashlib.sha256(http.request("GET", url).data).hexdigest() == f.sha256
+    assert uploader.profiles[0].token == mock_github.token
+    assert mock_github.request_counts["policy"] == 3
+
+    with pytest.raises(ghuc.UploadError, match="unsupported MIME type"):
+        uploader.upload(pathlib.Path(webp_file.path))
+
+    # Credentials that were just refreshed are not refreshed again.
+    mock_github.expire_token()
+    with pytest.raises(ghuc.UploadError, match="unexpected 422"):
+        uploader.upload(pathlib.Path(png_file.path))
+    monkeypatch.setattr(ghuc, "FRESH_CREDENTIALS_PERIOD", 0)
+    assert uploader.upload(pathlib.Path(png_file.path))
+    assert uploader.profiles[0].token == mock_github.token
+
+
+def test_upload_metrics(mock_github, tmp_path, png_file, pdf_file):
+    uploader = make_mock_uploader(mock_github, tmp_path)
+    png_path = pathlib.Path(png_file.path)
+    pdf_path = pathlib.Path(pdf_file.path)
+    uploader.upload(png_path)
+    uploader.upload(pdf_path)
+    uploader.upload(png_path)
+    with pytest.raises(ghuc.UploadError):
+        uploader.upload(tmp_path / "nonexistent.png")
+
+    metrics = uploader.metrics.as_dict(uploader.http_client)
+    counters = metrics["counters"]
+    assert counters["uploads{success}"] == 2
+    assert counters["uploads{cached}"] == 1
+    assert counters["uploads{failure}"] == 1
+    size = png_path.stat().st_size + pdf_path.stat().st_size
+    assert counters["uploaded_bytes"] == size
+    assert counters["retries"] == 1
+    assert counters["credential_refreshes{http}"] == 1
+    phases = metrics["phases"]
+    assert phases["upload"]["count"] == 4
+    assert phases["policy"]["count"] == 3
+    assert phases["transfer"]["count"] == 2
+    assert phases["register"]["count"] == 2
+    assert phases["refresh"]["count"] == 1
+    # Connections to the mock server are reused across requests.
+    (stats,) = metrics["connections"].values()
+    assert stats["requests"] > stats["connections"]
+
+    text = uploader.metrics.prometheus_text(uploader.http_client)
+    # Every sample belongs to a declared family of the same name (plus the
+    # histogram suffixes), as the Prometheus text format requires.
+    types = dict(
+        line.split()[2:4] for line in text.splitlines() if line.startswith("# TYPE")
+    )
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            family = re.sub(r"_(bucket|sum|count)$", "", name)
+            assert name in types or types.get(family) == "histogram", line
+    assert types["ghuc_uploads_total"] == "counter"
+    assert "# EOF" not in text
+    try:
+        from prometheus_client.parser import text_string_to_metric_families
+    except ImportError:
+        pass
+    else:
+        families = {f.name: f for f in text_string_to_metric_families(text)}
+        assert families["ghuc_uploads"].type == "counter"
+    assert "# TYPE ghuc_phase_duration_seconds histogram\n" in text
+    assert 'ghuc_phase_duration_seconds_count{phase="transfer"} 2\n' in text
+    assert 'ghuc_phase_duration_seconds_bucket{phase="upload",le="+Inf"} 4\n' in text
+    assert 'ghuc_uploads_total{result="cached"} 1\n' in text
+
+    # Metrics files are readable by collectors running as other users.
+    umask = os.umask(0o022)
+    try:
+        ghuc.write_metrics_file(uploader, tmp_path / "ghuc.prom")
+    finally:
+        os.umask(umask)
+    assert (tmp_path / "ghuc.prom").stat().st_mode & 0o777 == 0o644
+
+
+def test_upload_policy(mock_github, tmp_path, png_file, webp_file):
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False)
+    webp_path = pathlib.Path(webp_file.path)
+    with pytest.raises(ghuc.UploadError, match="unsupported MIME type image/webp"):
+        uploader.upload(webp_path)
+    policy_requests = mock_github.request_counts["policy"]
+    # Rejected types are learned, and persisted for other uploaders.
+    for u in (uploader, ghuc.Uploader(data_dir=tmp_path, github_url=mock_github.url)):
+        with pytest.raises(ghuc.UploadError, match="unsupported MIME type image/webp"):
+            u.upload(webp_path)
+    assert mock_github.request_counts["policy"] == policy_requests
+
+    # Size limits are checked locally, and can be overridden.
+    png_path = pathlib.Path(png_file.path)
+    size = png_path.stat().st_size
+    policy = json.loads((tmp_path / "policy.json").read_text())
+    policy["limits"] = {"image/png": size - 1}
+    (tmp_path / "policy.json").write_text(json.dumps(policy))
+    uploader = ghuc.Uploader(data_dir=tmp_path, github_url=mock_github.url)
+    with pytest.raises(ghuc.UploadError, match="file too large"):
+        uploader.upload(png_path)
+    assert mock_github.request_counts["policy"] == policy_requests
+
+    # Learned rejections expire.
+    uploader.policy.max_age = 0
+    with pytest.raises(ghuc.UploadError, match="unsupported MIME type image/webp"):
+        uploader.upload(webp_path)
+    assert mock_github.request_counts["policy"] == policy_requests + 1
+
+
+def test_image_optimization(mock_github, tmp_path):
+    source = tmp_path / "photo.jpg"
+    exif = Image.Exif()
+    exif[0x010F] = "Camera Maker"
+    Image.new("RGB", (400, 300), (200, 100, 50)).save(
+        str(source), quality=100, exif=exif.tobytes()
+    )
+    uploader = make_mock_uploader(
+        mock_github,
+        tmp_path / "data",
+        use_cache=False,
+        max_dimension=100,
+        strip_metadata=True,
+        cache_dir=tmp_path / "cache",
+    )
+    url = uploader.upload(source)
+    assert url.endswith("/photo.jpg")
+    with Image.open(io.BytesIO(http.request("GET", url).data)) as im:
+        assert im.size == (100, 75)
+        assert "exif" not in im.info
+
+    # Optimized images are cached by source digest.
+    (optimized,) = (tmp_path / "cache" / "optimized").glob("*/photo.jpg")
+    mtime = optimized.stat().st_mtime_ns
+    assert uploader.optimizer.optimize(source, "image/jpeg") == optimized
+    assert optimized.stat().st_mtime_ns == mtime
+
+    # JPEGs that aren't resized are stripped losslessly, keeping their
+    # orientation.
+    exif[0x0112] = 6
+    Image.new("RGB", (400, 300), (200, 100, 50)).save(
+        str(source), quality=90, exif=exif.tobytes()
+    )
+    cache_dir = tmp_path / "cache" / "optimized"
+    optimizer = ghuc.ImageOptimizer(cache_dir, strip_metadata=True)
+    stripped = optimizer.optimize(source, "image/jpeg")
+    optimizer.close()
+    assert stripped.stat().st_size < source.stat().st_size
+    with Image.open(str(source)) as original, Image.open(str(stripped)) as im:
+        assert im.tobytes() == original.tobytes()
+        assert dict(im.getexif()) == {0x0112: 6}
+
+    # Entries unused for too long are evicted.
+    expired = cache_dir / "expired"
+    expired.mkdir()
+    os.utime(str(expired), (0, 0))
+    optimizer = ghuc.ImageOptimizer(cache_dir, max_entries=1)
+    optimizer.prune()
+    assert list(cache_dir.iterdir()) == [stripped.parent]
+
+
+def test_throttling(mock_github, tmp_path, monkeypatch, png_file):
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False, jobs=4)
+    png_path = pathlib.Path(png_file.path)
+    uploader.upload(png_path)
+    policy_requests = mock_github.request_counts["policy"]
+
+    # Throttled uploads back off for Retry-After, with less concurrency.
+    mock_github.throttle(2, retry_after=0.2)
+    start = time.monotonic()
+    assert uploader.upload(png_path)
+    assert time.monotonic() - start >= 0.4
+    assert mock_github.request_counts["policy"] == policy_requests + 3
+    assert uploader.metrics.as_dict()["counters"]["throttled{policy}"] == 2
+    assert uploader.limiter.limit < 4
+
+    # Persistent throttling is eventually reported as an error.
+    monkeypatch.setattr(ghuc, "MAX_THROTTLED_RETRIES", 1)
+    mock_github.throttle(2, retry_after=0)
+    with pytest.raises(ghuc.Throttled, match="HTTP 429"):
+        uploader.upload(png_path)
+
+
+def test_credential_profiles(mock_github, tmp_path, png_file):
+    for name in ("a", "b"):
+        store = ghuc.CredentialStore(tmp_path / "profiles" / name)
+        store.directory.mkdir(parents=True)
+        with store.lock():
+            store.save(
+                [{"name": "user_session", "value": mock_github.session}],
+                mock_github.token,
+            )
+    uploader = ghuc.Uploader(
+        data_dir=tmp_path,
+        github_url=mock_github.url,
+        use_cache=False,
+        profiles=["a", "b"],
+    )
+    assert [p.name for p in uploader.profiles] == ["a", "b"]
+    assert uploader.profiles[1].env_var("GITHUB_PASSWORD") == "GITHUB_PASSWORD_B"
+    png_path = pathlib.Path(png_file.path)
+
+    # Uploads are spread across profiles.
+    for _ in range(4):
+        uploader.upload(png_path)
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["profile_uploads{a}"] == counters["profile_uploads{b}"] == 2
+
+    # A throttled profile is taken out of rotation, without holding up
+    # uploads through the other one.
+    mock_github.throttle(1, retry_after=10)
+    start = time.monotonic()
+    uploader.upload(png_path)
+    uploader.upload(png_path)
+    assert time.monotonic() - start < 5
+    assert uploader.profiles[0].throttled_until > time.monotonic()
+    counters = uploader.metrics.as_dict()["counters"]
+    assert (counters["profile_uploads{a}"], counters["profile_uploads{b}"]) == (2, 4)
+    assert "profile b: 4 uploads" in uploader.metrics.summary()
+
+    with pytest.raises(ValueError, match="invalid profile name"):
+        ghuc.Uploader(data_dir=tmp_path, profiles=["../evil"])
+
+
+def test_verify(mock_github, tmp_path, monkeypatch, png_file, pdf_file):
+    monkeypatch.setattr(ghuc, "VERIFY_INITIAL_DELAY", 0.01)
+    uploader = make_mock_uploader(
+        mock_github, tmp_path, use_cache=False, verify=True, jobs=2
+    )
+    paths = [pathlib.Path(f.path) for f in (png_file, pdf_file)]
+
+    # Assets that aren't served yet are polled until they are; the files
+    # are hashed while being uploaded, not read again.
+    mock_github.hide_assets(3)
+    reads = []
+    sha256_file = ghuc.sha256_file
+    monkeypatch.setattr(
+        ghuc, "sha256_file", lambda path: reads.append(path) or sha256_file(path)
+    )
+    results = list(uploader.upload_many(paths, ordered=True))
+    assert [r.error for r in results] == [None, None]
+    assert [r.sha256 for r in results] == [png_file.sha256, pdf_file.sha256]
+    assert reads == []
+    assert mock_github.request_counts["asset"] == 5
+    assert uploader.metrics.as_dict()["counters"]["verifications{ok}"] == 2
+
+    mock_github.corrupt_assets = True
+    with pytest.raises(ghuc.UploadError, match="verification failed: .* SHA-256"):
+        uploader.upload(paths[0])
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["verifications{mismatch}"] == 1
+    assert counters["uploads{failure}"] == 1
+
+
+def test_http2_transport(mock_github, tmp_path, png_file, pdf_file):
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    # The mock server only speaks HTTP/1.1, which httpx falls back to.
+    uploader = make_mock_uploader(
+        mock_github, tmp_path, use_cache=False, transport="http2"
+    )
+    for f in (png_file, pdf_file):
+        url = uploader.upload(pathlib.Path(f.path))
+        assert hashlib.sha256(http.request("GET", url).data).hexdigest() == f.sha256
+    # The stale token was refreshed over the transport, too.
+    assert uploader.profiles[0].token == mock_github.token
+    # Only transfers went through urllib3.
+    (stats,) = uploader.metrics.as_dict(uploader.http_client)["connections"].values()
+    assert stats["requests"] == 2
+
+    with pytest.raises(ValueError, match="unknown transport"):
+        ghuc.Uploader(data_dir=tmp_path, transport="carrier-pigeon")
+
+
+def test_bundle_and_gzip(mock_github, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # SpooledTemporaryFile has no readinto before Python 3.11.
+    monkeypatch.delattr(tempfile.SpooledTemporaryFile, "readinto", raising=False)
+    for name, content in [
+        ("logs/a.log", b"a" * 100),
+        ("logs/sub/b.txt", b"b" * 100),
+        ("big.log", b"ghuc\n" * (1 << 18)),
+    ]:
+        path = pathlib.Path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    data_dir = tmp_path / "data"
+    uploader = make_mock_uploader(
+        mock_github, data_dir, use_cache=False, compress_text=True
+    )
+
+    # Bundles are uploaded as a single asset.
+    paths = ghuc.expand_paths(
+        [pathlib.Path("logs"), pathlib.Path("logs/a.log")], extensions=None
+    )
+    url = uploader.upload_bundle(paths, "logs.zip")
+    assert url.endswith("/logs.zip")
+    assert mock_github.request_counts["policy"] == 2
+    with zipfile.ZipFile(io.BytesIO(http.request("GET", url).data)) as archive:
+        assert archive.namelist() == ["logs/a.log", "logs/sub/b.txt", "logs/a-2.log"]
+        assert archive.read("logs/sub/b.txt") == b"b" * 100
+
+    # Large text files are gzipped, small ones aren't.
+    info = {}
+    url = uploader.upload(pathlib.Path("big.log"), info)
+    assert url.endswith("/big.log.gz")
+    assert info["mime"] == "application/gzip"
+    assert info["size"] < 1 << 16
+    assert gzip.decompress(http.request("GET", url).data) == b"ghuc\n" * (1 << 18)
+    assert uploader.upload(pathlib.Path("logs/a.log")).endswith("/a.log")
+
+    with pytest.raises(ghuc.UploadError, match="does not exist"):
+        uploader.upload_bundle([pathlib.Path("missing.txt")], "missing.zip")
+
+
+def test_phase_retries(mock_github, tmp_path, monkeypatch, png_file):
+    monkeypatch.setattr(ghuc, "PHASE_RETRY_BASE_DELAY", 0.01)
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False)
+    png_path = pathlib.Path(png_file.path)
+    uploader.upload(png_path)
+    counts = dict(mock_github.request_counts)
+
+    def new_requests(endpoint):
+        return mock_github.request_counts[endpoint] - counts[endpoint]
+
+    # Failed registrations are retried without transferring the file again.
+    mock_github.fail("register", 2)
+    assert uploader.upload(png_path)
+    assert (new_requests("policy"), new_requests("s3")) == (1, 1)
+    assert new_requests("register") == 3
+
+    # Failed transfers are retried with the same policy...
+    counts = dict(mock_github.request_counts)
+    mock_github.fail("s3", 1)
+    assert uploader.upload(png_path)
+    assert (new_requests("policy"), new_requests("s3")) == (1, 2)
+
+    # ...unless it's about to expire.
+    counts = dict(mock_github.request_counts)
+    mock_github.policy_ttl = 30
+    mock_github.fail("s3", 1)
+    assert uploader.upload(png_path)
+    assert (new_requests("policy"), new_requests("s3")) == (2, 2)
+
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["phase_retries{register}"] == 2
+    assert counters["phase_retries{transfer}"] == 2
+    assert counters["wasted_bytes"] > 2 * png_path.stat().st_size
+    assert "phase retries: 4" in uploader.metrics.summary()
+
+    # Plain 503s are server errors, and throttled transfers and
+    # registrations resume where they left off.
+    mock_github.policy_ttl = 1800
+    for endpoint, status, retry_after, expected in [
+        ("register", 503, None, (1, 1, 2)),
+        ("register", 403, 0, (1, 1, 2)),
+        ("s3", 503, 0, (1, 2, 1)),
+    ]:
+        counts = dict(mock_github.request_counts)
+        mock_github.fail(endpoint, 1, status, retry_after)
+        assert uploader.upload(png_path)
+        assert tuple(map(new_requests, ("policy", "s3", "register"))) == expected
+    counters = uploader.metrics.as_dict()["counters"]
+    assert counters["phase_retries{register}"] == 3
+    assert counters["throttled{register}"] == 1
+    assert counters["throttled{transfer}"] == 1
+
+    monkeypatch.setattr(ghuc, "MAX_PHASE_RETRIES", 1)
+    mock_github.fail("policy", 2)
+    with pytest.raises(ghuc.TransientError, match="HTTP 500"):
+        uploader.upload(png_path)
+
+
+def test_token_bucket():
+    bucket = ghuc.TokenBucket(1000, 100)
+    start = time.monotonic()
+    bucket.consume(100)
+    assert time.monotonic() - start < 0.05
+    # Overdrawing the bucket sleeps off the debt.
+    bucket.consume(200)
+    assert time.monotonic() - start >= 0.19
+
+
+def test_prewarm(mock_github, tmp_path, png_file):
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False, jobs=2)
+    uploader.prewarm()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if uploader.metrics.as_dict()["counters"].get(
+            "prewarmed_connections{%s}" % mock_github.url
+        ):
+            break
+        time.sleep(0.01)
+    uploader.upload(pathlib.Path(png_file.path))
+    # The upload host is remembered for the next prewarm.
+    assert (tmp_path / "upload_origin").read_text().strip() == mock_github.url
+    (stats,) = uploader.metrics.as_dict(uploader.http_client)["connections"].values()
+    assert stats["prewarmed"] >= 1
+    assert stats["pool_hits"] == stats["requests"] - stats["pool_misses"]
+    assert stats["pool_misses"] == 0
+
+
+def test_pipelined_phases(mock_github, tmp_path, png_file, jpeg_file, pdf_file):
+    mock_github.latency = 0.05
+    uploader = make_mock_uploader(mock_github, tmp_path, use_cache=False)
+    uploader.ensure_credentials()
+    active = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def traced(phase, fn):
+        def wrapper(*args):
+            with lock:
+                overlaps.extend({phase, other} for other in active)
+                active.add(phase)
+            try:
+                return fn(*args)
+            finally:
+                with lock:
+                    active.discard(phase)
+
+        return wrapper
+
+    for phase in ("request_policy", "transfer", "register"):
+        method = "_" + phase
+        setattr(uploader, method, traced(phase, getattr(uploader, method)))
+    paths = [pathlib.Path(f.path) for f in (png_file, jpeg_file, pdf_file)]
+    results = list(uploader.upload_many(paths, ordered=True))
+    assert all(result.url for result in results)
+    # Even with a single job, policies are fetched during transfers.
+    assert {"request_policy", "transfer"} in overlaps
+
+    # Overlapping phases don't discard connections.
+    results = list(uploader.upload_many(paths * 4))
+    assert all(result.url for result in results)
+    (stats,) = uploader.metrics.as_dict(uploader.http_client)["connections"].values()
+    assert stats["connections"] <= len(ghuc.NETWORK_PHASES)
+    with uploader:
+        pass
+    assert not uploader._phase_executors
+
+
+def test_journal(mock_github, tmp_path):
+    paths = []
+    for name in ("a.txt", "b.txt"):
+        path = tmp_path / name
+        path.write_text(name)
+        paths.append(path)
+    journal_path = tmp_path / "journal"
+    uploader = make_mock_uploader(mock_github, tmp_path / "data", use_cache=False)
+
+    journal = ghuc.UploadJournal(journal_path)
+    urls = [r.url for r in uploader.upload_many(paths, ordered=True, journal=journal)]
+    assert all(urls)
+    journal.close(compact=False)
+    assert len(journal_path.read_text().splitlines()) == 4
+
+    # A resumed run skips finished uploads, tolerating a torn last line, and
+    # retries changed files.
+    with journal_path.open("a") as fp:
+        fp.write('{"path": "%s", "star' % paths[0])
+    paths[1].write_text("b, changed")
+    policies = mock_github.request_counts["policy"]
+    journal = ghuc.UploadJournal(journal_path)
+    results = list(uploader.upload_many(paths, ordered=True, journal=journal))
+    assert results[0].url == urls[0]
+    assert results[0].size == 5
+    assert results[1].url and not results[1].error
+    assert mock_github.request_counts["policy"] == policies + 1
+    assert uploader.metrics.counters[("uploads", "journaled")] == 1
+
+    # Compaction keeps the latest finished entry of each path, and the
+    # journal's mode.
+    journal_path.chmod(0o664)
+    journal.close()
+    assert journal_path.stat().st_mode & 0o777 == 0o664
+    entries = [json.loads(line) for line in journal_path.read_text().splitlines()]
+    assert [entry["path"] for entry in entries] == [str(p) for p in paths]
+    assert entries[1]["size"] == len("b, changed")
+
+    # Files modified while uploading are journaled as they were before.
+    upload = uploader.upload
+
+    def upload_and_modify(path, info=None):
+        url = upload(path, info)
+        path.write_text("a, modified during upload")
+        return url
+
+    uploader.upload = upload_and_modify
+    journal = ghuc.UploadJournal(journal_path)
+    (path,) = paths[:1]
+    path.write_text("a, changed")
+    list(uploader.upload_many([path], journal=journal))
+    journal.close()
+    journal = ghuc.UploadJournal(journal_path)
+    assert journal.lookup(path) is None
+    journal.close()